@@ -0,0 +1,89 @@
+import bisect
+
+
+class AlertIndex:
+    """An in-memory index of price alerts grouped by ticker. The target prices of ABOVE and BELOW
+    alerts are kept in sorted lists so that the alerts triggered by a price can be found with a
+    bisect, instead of comparing the price against every alert for the ticker.
+    """
+
+    def __init__(self):
+        self.alerts = {} # str(_id) -> alert document
+        self._above = {} # ticker -> sorted list of (target_price, str(_id))
+        self._below = {} # ticker -> sorted list of (target_price, str(_id))
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def tickers(self):
+        """Returns the tickers that have at least one alert."""
+        return set(self._above) | set(self._below)
+
+    def _side(self, alert: dict):
+        return self._above if alert["execute"] == "ABOVE" else self._below
+
+    def add(self, alert: dict):
+        """Adds a price alert document (which must have an _id) to the index."""
+        key = str(alert["_id"])
+        if key in self.alerts:
+            self.remove(key)
+        self.alerts[key] = alert
+        ticker = alert["quote_ticker"].upper()
+        bisect.insort(self._side(alert).setdefault(ticker, []), (alert["target_price"], key))
+
+    def remove(self, _id):
+        """Removes a price alert from the index by its _id. Does nothing if it isn't indexed."""
+        key = str(_id)
+        alert = self.alerts.pop(key, None)
+        if alert is None:
+            return
+        side = self._side(alert)
+        ticker = alert["quote_ticker"].upper()
+        thresholds = side[ticker]
+        i = bisect.bisect_left(thresholds, (alert["target_price"], key))
+        if i < len(thresholds) and thresholds[i][1] == key:
+            del thresholds[i]
+        if not thresholds:
+            del side[ticker]
+
+    def triggered(self, ticker: str, price: float):
+        """Returns the alerts for a ticker that have been reached at a price.
+
+        Args:
+            ticker (str): The ticker of the stock or crypto.
+            price (float): The current price.
+
+        Returns:
+            list: The alert documents whose ABOVE target is below the price or whose BELOW
+                target is above the price.
+        """
+        ticker = ticker.upper()
+        output = []
+        above = self._above.get(ticker)
+        if above:
+            # (price,) sorts before every (price, _id) so alerts with a target equal to the price are excluded
+            i = bisect.bisect_left(above, (price,))
+            output.extend(self.alerts[key] for _, key in above[:i])
+        below = self._below.get(ticker)
+        if below:
+            # "\uffff" sorts after every _id so alerts with a target equal to the price are excluded
+            i = bisect.bisect_right(below, (price, "\uffff"))
+            output.extend(self.alerts[key] for _, key in below[i:])
+        return output
+
+    def distances(self, ticker: str, price: float):
+        """Returns the relative distances from a price to the nearest ABOVE and BELOW targets of a
+        ticker. The distance of a side is 0 if one of its alerts has already been reached.
+        """
+        # A price of 0 has no relative distance to anything
+        if price <= 0:
+            return []
+        ticker = ticker.upper()
+        output = []
+        above = self._above.get(ticker)
+        if above:
+            output.append(max(0, (above[0][0] - price) / price))
+        below = self._below.get(ticker)
+        if below:
+            output.append(max(0, (price - below[-1][0]) / price))
+        return output
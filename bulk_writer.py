@@ -0,0 +1,74 @@
+from pymongo import DeleteOne, UpdateOne
+import pymongo.errors
+
+
+class BulkWriter:
+    """Collects the writes to a collection during a cycle and commits them together in ordered
+    bulk_write batches, instead of making one round-trip per write. Each failed write is reported
+    with the error of that operation, and writes that failed or didn't run because an earlier one
+    failed are kept to be retried on the next commit. Writes are never dropped.
+    """
+
+    def __init__(self, collection, name: str, batch_size: int = 500):
+        """
+        Args:
+            collection (motor.motor_asyncio.AsyncIOMotorCollection): The collection written to.
+            name (str): The name of the collection in error messages.
+            batch_size (int, optional): The maximum number of writes sent in one bulk_write.
+        """
+        self.collection = collection
+        self.name = name
+        self.batch_size = batch_size
+        self.committed = 0
+        self.failed = 0 # The number of failed attempts
+        self._pending = [] # list of [operation, attempts]
+
+    def __len__(self):
+        return len(self._pending)
+
+    def delete(self, _id):
+        """Queues the deletion of a document."""
+        self._pending.append([DeleteOne({"_id": _id}), 0])
+
+    def update(self, _id, update: dict):
+        """Queues an update of a document."""
+        self._pending.append([UpdateOne({"_id": _id}, update), 0])
+
+    async def commit(self):
+        """Sends the queued writes in ordered batches.
+
+        Returns:
+            int: The number of writes that were committed.
+        """
+        pending, self._pending = self._pending, []
+        committed = 0
+        retry = []
+        for i in range(0, len(pending), self.batch_size):
+            batch = pending[i:i + self.batch_size]
+            try:
+                await self.collection.bulk_write([operation for operation, _ in batch], ordered=True)
+                committed += len(batch)
+            except pymongo.errors.BulkWriteError as e:
+                # An ordered batch stops at its first error, so the writes before it were committed
+                errors = e.details["writeErrors"]
+                for error in errors:
+                    print(f"Bulk write to {self.name} failed at {batch[error['index']][0]}\n{error['code']}: {error['errmsg']}")
+                stopped_at = errors[0]["index"] if errors else len(batch)
+                committed += stopped_at
+                retry.extend(self._retry(batch[stopped_at:]))
+            except pymongo.errors.PyMongoError as e:
+                print(f"Bulk write of {len(batch)} operations to {self.name} failed\n{e.__class__.__name__}: {e}")
+                retry.extend(self._retry(batch))
+        # Keep the writes that failed ahead of the ones queued during the commit
+        self._pending[:0] = retry
+        self.committed += committed
+        return committed
+
+    def _retry(self, writes: list):
+        """Counts a failed attempt of each write and returns them to be retried on the next commit."""
+        for write in writes:
+            write[1] += 1
+            self.failed += 1
+            if write[1] % 10 == 0:
+                print(f"The write to {self.name} {write[0]} has failed {write[1]} times, retrying it on the next commit")
+        return writes
@@ -7,6 +7,7 @@ import aiohttp
 import datetime
 import pandas as pd
 import pandas_datareader.data as web
+from pandas_datareader._utils import RemoteDataError
 import plotly.express as px
 import os
 from bs4 import BeautifulSoup
@@ -171,16 +172,30 @@ class Commands(commands.Cog, name="General Commands"):
             # Retrieve all the data
             @insensitive_ticker
             async def get_data(self, quote_ticker: str, period1: datetime.datetime, period2: datetime.datetime): # self is required so that the command can be used with the insensitive_ticker decorator
-                loop = asyncio.get_event_loop()
-                try:
+                async def fetch():
+                    loop = asyncio.get_event_loop()
+                    await self.bot.rate_limiters["web"].acquire() # DataReader makes its own request to Yahoo Finance
                     output = await loop.run_in_executor(None, lambda: web.DataReader(quote_ticker, 'yahoo', period1, period2))
-                except:
+                    return pd.DataFrame(output['Close'])
+                def decode(value):
+                    df = pd.read_json(value, orient="split")
+                    df.index = pd.to_datetime(df.index)
+                    return df
+                # Key the recorded data by the length of the time period since the dates change every day
+                key = f"web GET yahoo-history {quote_ticker.upper()} {(period2 - period1).days}d"
+                try:
+                    df = await self.bot.fixtures.call(key, fetch, encode=lambda df: df.to_json(orient="split", date_format="iso"), decode=decode)
+                except (RemoteDataError, KeyError):
                     return {
                         "error": "Could not retrieve data from Yahoo Finance.",
                         "error_code": 404
                     } # Ticker is invalid
-                output = output['Close']
-                df = pd.DataFrame(output)
+                except Exception as e:
+                    # Network errors and throttling don't mean the ticker is invalid
+                    return {
+                        "error": f"The request to Yahoo Finance failed ({e.__class__.__name__}).",
+                        "error_code": 503
+                    }
                 return df
             df = await get_data(self, quote_ticker, period1, period2)
             if type(df) == dict: # 404 not found
@@ -369,10 +384,13 @@ class Commands(commands.Cog, name="General Commands"):
         ticker = ticker.upper()
 
         # Make the request to get the data
-        url = f"https://www.alphavantage.co/query?function=NEWS_SENTIMENT&tickers={ticker}&apikey={Config.ALPHA_VANTAGE_API_KEY}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                data = await resp.json()
+        url = "https://www.alphavantage.co/query"
+        params = {
+            "function": "NEWS_SENTIMENT",
+            "tickers": ticker,
+            "apikey": Config.ALPHA_VANTAGE_API_KEY
+        }
+        data = await self.bot.http_request("alphavantage", "GET", url, params=params)
         
         # Handle the ticker not being found
         if "Information" in list(data.keys()):
@@ -452,13 +470,9 @@ class Commands(commands.Cog, name="General Commands"):
     async def lookup(self, ctx: commands.Context, *, name: str):
         await ctx.trigger_typing()
 
-        # Generate the url
-        url = f"https://finance.yahoo.com/lookup?s={name}"
-        
         # Make the request to the site
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                html = await resp.text()
+        url = "https://finance.yahoo.com/lookup"
+        html = await self.bot.http_request("web", "GET", url, response_type="text", params={"s": name})
         
         # Parse the html to get the potential matches
         soup = BeautifulSoup(html, "html.parser")
@@ -510,9 +524,7 @@ class Commands(commands.Cog, name="General Commands"):
         async def get_data(index_path: str):
             # Generate the url and make the request
             url = f"https://www.ig.com/en/indices/markets-indices/{index_path}"
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as resp:
-                    html = await resp.text()
+            html = await self.bot.http_request("web", "GET", url, response_type="text")
             # Parse the html and extract the data
             soup = BeautifulSoup(html, "html.parser")
             data = {}
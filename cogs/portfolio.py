@@ -6,29 +6,33 @@ import datetime
 import inspect
 
 from extras import *
+from config import Config
+from indexes import query_shape
 
 
 class Portfolio(commands.Cog, name="Portfolio Commands"):
 
     def __init__(self, bot):
         self.bot: ProfitGreenBot = bot
+        # Write the buffered trades in batches and migrate embedded trade histories on startup
+        self.bot.trade_log.start()
 
         # Cog data
         self.emoji = ":dollar:"
     
     """
-    Trade Logging:
-    "trade_history": [
-        {
-            "_type": "BUY",
-            "datetime": "2022-07-06 10:10:52.165995",
-            "timestamp": 1657116677.7689857,
-            "ticker": "AAPL",
-            "quantity": 100,
-            "price": 123.456,
-            "vote_reward": True
-        }
-    ]
+    Trade Logging (one document per trade in the TradeHistory collection):
+    {
+        "_id": ObjectID("5e9f8f8f8f8f8f8f8f8f8f8"),
+        "user_id": 81234818238418324,
+        "_type": "BUY",
+        "datetime": "2022-07-06 10:10:52.165995",
+        "timestamp": 1657116677.7689857,
+        "ticker": "AAPL",
+        "quantity": 100,
+        "price": 123.456,
+        "vote_reward": True
+    }
     """
 
     @commands.Cog.listener()
@@ -55,8 +59,8 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
 
         # Retrieve the user's portfolio data from the database
         portfolio_data = await self.bot.fetch_portfolio(user.id)
-        balance = portfolio_data["balance"]
-        portfolio = portfolio_data["portfolio"]
+        balance = round(portfolio_data["balance"], 3)
+        portfolio = [holding for holding in portfolio_data["portfolio"] if holding["quantity"] > 0] # Skip empty holdings left by older sells
 
         # Check to make sure the user has quotes in their portfolio
         if portfolio == []:
@@ -76,10 +80,12 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
             return await ctx.send(embeds=[em])
 
         # Retrieve the current prices of the quotes in the user's portfolio
-        coroutines = []
-        for quote in portfolio:
-            coroutines.append(self.bot.fetch_brief(quote["ticker"]))
-        price_data = list(await asyncio.gather(*coroutines)) # Run the coroutines in parallel
+        quotes = await self.bot.price_hub.fetch([quote["ticker"] for quote in portfolio])
+        # Copy the prices into dicts that can also hold the user-specific data about each quote
+        price_data = []
+        for holding in portfolio:
+            quote = quotes[holding["ticker"].upper()]
+            price_data.append({"ticker": quote.ticker, "name": quote.name, "price": quote.price})
         price_data.sort(key=lambda p: p["ticker"])
 
         # Get the total value of the portfolio
@@ -209,6 +215,7 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
             }
         }
     )
+    @query_shape("Tasks", {"user_id": 0, "_type": "LIMIT_ORDER", "limit_order_type": "BUY"})
     async def buy(self, ctx: commands.Context, ticker: str, quantity: str = "1", order_type: str = "market", execute_price: str = None):
         # TODO: Limit the number of quotes that people can buy to a maximum of 24
         await ctx.trigger_typing()
@@ -235,7 +242,7 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
                 return await ctx.send(":x: The `execute_price` parameter must be a valid number.")
 
         # Retrieve all data
-        price_data = await self.bot.fetch_brief(ticker)
+        price_data = await self.bot.fetch_brief(ticker, max_age=Config.TRADE_QUOTE_MAX_AGE)
         portfolio_data = await self.bot.fetch_portfolio(ctx.author.id)
         balance = round(portfolio_data["balance"], 3)
 
@@ -243,8 +250,8 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
         if price_data.get("error_code") is not None:
             return await ctx.send(":x: Please enter a valid ticker.")
         else:
-            price = round(price_data.get("price"), 5)
-            ticker = price_data.get("ticker")
+            price = round(price_data.price, 5)
+            ticker = price_data.ticker
 
         # Calculate total cost
         if order_type == "MARKET":
@@ -314,41 +321,32 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
         
         async def on_confirm(btn: discord.ui.Button, interaction: discord.Interaction):
             if order_type == "LIMIT":
-                await self.bot.tasks.insert_one(
-                    {
-                        "_type": "LIMIT_ORDER",
-                        "user_id": ctx.author.id,
-                        "limit_order_type": "BUY",
-                        "ticker": ticker,
-                        "quantity": quantity,
-                        "execute_price": execute_price,
-                        "timestamp": round(time.time()),
-                        "notified": False
-                    }
-                )
+                limit_order = {
+                    "_type": "LIMIT_ORDER",
+                    "user_id": ctx.author.id,
+                    "limit_order_type": "BUY",
+                    "ticker": ticker,
+                    "quantity": quantity,
+                    "execute_price": execute_price,
+                    "timestamp": round(time.time()),
+                    "notified": False
+                }
+                await self.bot.tasks.insert_one(limit_order) # insert_one adds the _id to limit_order
+                self.bot.order_book.add(limit_order)
+                self.bot.price_hub.track(ticker)
             elif order_type == "MARKET":
-                portfolio_data["balance"] = round(balance - total, 3)
-                # Update the quantity and the buy price if the user already has the quote in their portfolio
-                for quote in portfolio_data["portfolio"]:
-                    if quote["ticker"] == ticker:
-                        quote["quantity"] += quantity
-                        quote["buy_price"] = round((quote["buy_price"] * quote["quantity"] + price * quantity) / (quote["quantity"] + quantity), 3)
-                        break
-                # Otherwise, add the quote to the portfolio in a new entry
-                else:
-                    portfolio_data["portfolio"].append(
-                        {
-                            "ticker": ticker,
-                            "quantity": quantity,
-                            "buy_price": price
-                        }
-                    )
-                # Update the database
-                await self.bot.portfolio.update_one(
-                    {"_id": ctx.author.id},
-                    {"$set": portfolio_data}
-                )
-                await self.bot.log_trade(ctx.author.id, "BUY", ticker.upper(), quantity, price) # Log the trade in the database as well
+                # Update the balance, the holding and the trade history in one atomic update
+                new_balance = await self.bot.buy_shares(ctx.author.id, ticker, quantity, price, cost=total, portfolio_data=portfolio_data)
+                # The user spent their cash elsewhere while the order was waiting for confirmation
+                if new_balance is None:
+                    em.title = ""
+                    em.description = ":x: You no longer have enough money to place this order."
+                    em.color = discord.Color.red()
+                    em.timestamp = discord.Embed.Empty
+                    em.set_footer(text="", icon_url="")
+                    view.clear_items()
+                    return await interaction.response.edit_message(embeds=[em], view=view)
+                self.bot.price_hub.track(ticker)
             # Edit the embed to show the user that the order was successful
             em.title = ""
             em.description = ":white_check_mark: Order placed successfully!"
@@ -389,6 +387,7 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
             }
         }
     )
+    @query_shape("Tasks", {"user_id": 0, "_type": "LIMIT_ORDER", "limit_order_type": "SELL", "ticker": "AAPL"})
     async def sell(self, ctx: commands.Context, ticker: str, quantity: str = "1", order_type: str = "market", execute_price: str = None):
         await ctx.trigger_typing()
 
@@ -414,7 +413,7 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
                 return await ctx.send(":x: The `execute_price` parameter must be a valid number.")
 
         # Retrieve all data
-        price_data = await self.bot.fetch_brief(ticker)
+        price_data = await self.bot.fetch_brief(ticker, max_age=Config.TRADE_QUOTE_MAX_AGE)
         portfolio_data = await self.bot.fetch_portfolio(ctx.author.id)
         balance = round(portfolio_data["balance"], 3)
 
@@ -422,8 +421,8 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
         if price_data.get("error_code") is not None:
             return await ctx.send(":x: Please enter a valid ticker symbol.")
         else:
-            price = round(price_data.get("price"), 5)
-            ticker = price_data.get("ticker")
+            price = round(price_data.price, 5)
+            ticker = price_data.ticker
         
         # Check if the user owns the quote. If they do, then store their user-specific data about it
         for quote in portfolio_data["portfolio"]:
@@ -498,23 +497,19 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
         
         async def on_confirm(btn: discord.ui.Button, interaction: discord.Interaction):
             if order_type == "MARKET":
-                portfolio_data["balance"] = round(balance + total, 3)
-                # Reduce the quantity of the quote by the quantity of the order
-                for quote in portfolio_data["portfolio"]:
-                    if quote["ticker"] == ticker:
-                        quote["quantity"] -= quantity
-                        break
-                # Remove the quote from the portfolio if the user sold all of their shares
-                if quote["quantity"] == 0:
-                    portfolio_data["portfolio"].remove(quote)
-                # Update the database
-                await self.bot.portfolio.update_one(
-                    {"_id": ctx.author.id},
-                    {"$set": portfolio_data}
-                )
-                await self.bot.log_trade(ctx.author.id, "SELL", ticker.upper(), quantity, price) # Log the trade in the database as well
+                # Update the balance, the holding and the trade history in one atomic update
+                new_balance = await self.bot.sell_shares(ctx.author.id, ticker, quantity, price)
+                # The user sold the shares elsewhere while the order was waiting for confirmation
+                if new_balance is None:
+                    em.title = ""
+                    em.description = f":x: You no longer have `{quantity}` shares to sell."
+                    em.color = discord.Color.red()
+                    em.timestamp = discord.Embed.Empty
+                    em.set_footer(text="", icon_url="")
+                    view.clear_items()
+                    return await interaction.response.edit_message(embeds=[em], view=view)
             elif order_type == "LIMIT":
-                await self.bot.tasks.insert_one({
+                limit_order = {
                     "_type": "LIMIT_ORDER",
                     "user_id": ctx.author.id,
                     "limit_order_type": "SELL",
@@ -523,7 +518,10 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
                     "execute_price": execute_price,
                     "timestamp": round(time.time()),
                     "notified": False
-                })
+                }
+                await self.bot.tasks.insert_one(limit_order) # insert_one adds the _id to limit_order
+                self.bot.order_book.add(limit_order)
+                self.bot.price_hub.track(ticker)
             # Edit the embed to show the user that the order was successful
             em.title = ""
             em.description = ":white_check_mark: Order placed successfully!"
@@ -560,17 +558,14 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
     )
     async def rewardstock(self, ctx: commands.Context):
         # Retrieve the data for all the reward stocks
-        coroutines = []
-        for stock in self.bot.reward_stocks:
-            coroutines.append(self.bot.cnbc_data(stock))
-        free_stock_data = list(await asyncio.gather(*coroutines))
+        free_stock_data = list((await self.bot.fetch_briefs(list(self.bot.reward_stocks))).values())
 
         # Create the string that will contain the data about the free stocks
         stock_list_str = ""
         for stock in free_stock_data:
-            ticker = stock['ticker']
-            price = stock['price']
-            shares = self.bot.reward_stocks[stock['ticker']]
+            ticker = stock.ticker
+            price = stock.price
+            shares = self.bot.reward_stocks[stock.ticker]
             total = round(price * shares, 2)
             stock_list_str += f" - Ticker: `{ticker}` --- Current Price: `${self.bot.commify(price)}` x Shares: `{shares}` = Total: `${self.bot.commify(total)}`\n"
 
@@ -599,6 +594,7 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
         brief="View your pending orders",
         description="See all the pending orders you have placed previously and some details about them. If you no longer want an order to execute, you can use the `deleteorder` command to delete it."
     )
+    @query_shape("Tasks", {"_type": "LIMIT_ORDER", "user_id": 0})
     async def view_pending_orders(self, ctx: commands.Context):
         await ctx.trigger_typing()
 
@@ -646,6 +642,7 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
             "usage_examples": ["AAPL", "MSFT", "BTC-USD"]
         }
     )
+    @query_shape("Tasks", {"_type": "LIMIT_ORDER", "user_id": 0, "ticker": "AAPL"})
     async def delete_pending_order(self, ctx: commands.Context, ticker: str):
         # Format args
         ticker = ticker.upper()
@@ -671,6 +668,7 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
                     "_id": pending_orders[0]["_id"]
                 }
             )
+            self.bot.order_book.remove(pending_orders[0]["_id"])
             return await ctx.send(f":white_check_mark: Your pending order for `{ticker}` has been removed.")
         
         # Create the embed containing all of the pending orders
@@ -698,6 +696,7 @@ class Portfolio(commands.Cog, name="Portfolio Commands"):
 
             # Remove the order from the database
             await self.bot.tasks.delete_one({"_id": selected_order["_id"]})
+            self.bot.order_book.remove(selected_order["_id"])
             await interaction.response.send_message(f":white_check_mark: Removed pending order for `{ticker}`.")
             
             # Regenerate the embed and disable all the buttons
@@ -4,6 +4,8 @@ from discord.ext import commands
 import datetime
 
 from extras import *
+from config import Config
+from indexes import query_shape
 
 
 class PriceTargets(commands.Cog, name="Price Target Commands"):
@@ -39,10 +41,11 @@ class PriceTargets(commands.Cog, name="Price Target Commands"):
             "usage_examples": ["AAPL 150.43", "TSLA 800.01", "BTC-USD 59000"],
         }
     )
+    @query_shape("Tasks", {"_type": "price_alert", "user_id": 0, "quote_ticker": "AAPL"})
     async def add_price_target(self, ctx: commands.Context, quote_ticker: str, target_price: str):
         await ctx.trigger_typing()
         # Check that the ticker is a valid ticker
-        quote_data = await self.bot.fetch_brief(quote_ticker)
+        quote_data = await self.bot.fetch_brief(quote_ticker, max_age=Config.TRADE_QUOTE_MAX_AGE)
         if quote_data.get("error") is not None:
             return await ctx.send(f":x: I could not find a quote with ticker `{quote_ticker.upper()}`.")
         
@@ -54,9 +57,9 @@ class PriceTargets(commands.Cog, name="Price Target Commands"):
         
         else:
             # Prevent the user from providing a target price that is lower than the current price
-            if target_price < float(quote_data["price"]):
+            if target_price < quote_data.price:
                 execute = "BELOW"
-            elif target_price > float(quote_data["price"]):
+            elif target_price > quote_data.price:
                 execute = "ABOVE"
             else:
                 return await ctx.send(f":x: The target price cannot be the same as the current price.")
@@ -75,16 +78,17 @@ class PriceTargets(commands.Cog, name="Price Target Commands"):
             if len(await cursor.to_list(length=None)) >= 3:
                 return await ctx.send(f":x: You cannot set more than 3 price targets for a quote.")
 
-            # Add the quote_ticker and target_price to the database
-            await self.bot.tasks.insert_one(
-                {
-                    "_type": "price_alert",
-                    "user_id": ctx.author.id,
-                    "quote_ticker": quote_ticker,
-                    "target_price": target_price,
-                    "execute": execute,
-                }
-            )
+            # Add the quote_ticker and target_price to the database and the alert index
+            price_target = {
+                "_type": "price_alert",
+                "user_id": ctx.author.id,
+                "quote_ticker": quote_ticker,
+                "target_price": target_price,
+                "execute": execute,
+            }
+            await self.bot.tasks.insert_one(price_target) # insert_one adds the _id to price_target
+            self.bot.alert_index.add(price_target)
+            self.bot.price_hub.track(quote_ticker)
             await ctx.send(f":white_check_mark: You will be notified when `{quote_ticker}` goes {execute.lower()} `${target_price}`.")
 
     @commands.command(
@@ -96,6 +100,7 @@ class PriceTargets(commands.Cog, name="Price Target Commands"):
             "usage_examples": ["AAPL", "TSLA", "BTC-USD"],
         }
     )
+    @query_shape("Tasks", {"_type": "price_alert", "user_id": 0, "quote_ticker": "AAPL"})
     async def remove_price_target(self, ctx: commands.Context, quote_ticker: str):
         # Format args
         quote_ticker = quote_ticker.upper()
@@ -121,6 +126,7 @@ class PriceTargets(commands.Cog, name="Price Target Commands"):
                     "_id": price_targets[0]["_id"]
                 }
             )
+            self.bot.alert_index.remove(price_targets[0]["_id"])
             return await ctx.send(f":white_check_mark: Your price target for `{quote_ticker}` has been removed.")
 
         # Create the embed containing all of the price targets
@@ -148,6 +154,7 @@ class PriceTargets(commands.Cog, name="Price Target Commands"):
 
             # Remove the price target from the database
             await self.bot.tasks.delete_one({"_id": selected_pt["_id"]})
+            self.bot.alert_index.remove(selected_pt["_id"])
             await interaction.response.send_message(f":white_check_mark: Removed price target for `{quote_ticker}`.")
             
             # Regenerate the embed and disable all the buttons
@@ -182,6 +189,7 @@ class PriceTargets(commands.Cog, name="Price Target Commands"):
         description="View all price targets that you have set. Once you are notified about a price target being reached, the target will no longer be displayed here.",
         aliases=["pricetarget", "pt"]
     )
+    @query_shape("Tasks", {"_type": "price_alert", "user_id": 0})
     async def pricetargets(self, ctx: commands.Context):
         # Connect to the database and fetch all price targets for the user
         cursor = self.bot.tasks.find(
@@ -2,21 +2,38 @@ import discord
 from discord.ext import commands
 from discord.ext import tasks
 
-import asyncio
 import datetime
+import pymongo.errors
+import time
 
+import market
 from extras import *
+from bulk_writer import BulkWriter
 from config import Config
+from scheduler import ProximityScheduler
+from worker_pool import WorkerPool
 
 
 class TaskManager(commands.Cog):
 
     def __init__(self, bot):
         self.bot: ProfitGreenBot = bot
+        # Check the tasks of each ticker more often the closer its price is to a trigger price
+        self.scheduler = ProximityScheduler(Config.TASK_MIN_INTERVAL, Config.TASK_MAX_STALENESS)
+        # Handle the tasks of each cycle concurrently, one at a time per user
+        self.price_target_pool = WorkerPool("check_price_targets", Config.TASK_CONCURRENCY, Config.TASK_CYCLE_DEADLINE)
+        self.limit_order_pool = WorkerPool("check_limit_orders", Config.TASK_CONCURRENCY, Config.TASK_CYCLE_DEADLINE)
+        # Commit the task deletions and updates of each cycle together
+        self.task_writes = BulkWriter(self.bot.tasks, "Tasks")
+        # The number of seconds before the claim of a limit order that was never released goes stale
+        self.order_claim_ttl = 10 * 60
 
-        if Config.PRODUCTION:
-            self.check_price_targets.start()
-            self.check_limit_orders.start()
+        # Run the tasks here unless they are left to the task workers
+        if self.bot.runs_tasks:
+            self.bot.tasks_watcher.start()
+            self.bot.price_hub.start()
+            self.bot.price_hub.subscribe(self.on_prices)
+            self.check_tasks.start()
         
     """
     Limit Order Example Task:
@@ -29,191 +46,323 @@ class TaskManager(commands.Cog):
         "quantity": 67,
         "timestamp": 123412341234,
         "user_id": 81234818238418324,
-        "notified": False # Used if the order fails
+        "notified": False, # Used if the order fails
+        "claimed_by": "worker-1", # Only set while the order is being executed
+        "claimed_at": 123412341234
     }
     """
     
     def cog_unload(self):
         """Cancels all tasks when cog is unloaded"""
-        self.check_price_targets.stop()
-        self.check_limit_orders.stop()
+        self.bot.price_hub.unsubscribe(self.on_prices)
+        self.bot.price_hub.stop()
+        self.check_tasks.stop()
 
     @commands.Cog.listener()
     async def on_ready(self):
         print("cogs.tasks is online")
+
+    @tasks.loop(seconds=5)
+    async def check_tasks(self):
+        try:
+            await self.check_due_tasks()
+        finally:
+            # Commit the task writes queued during the cycle and by notifications sent since the
+            # last one, and the trades of the cycle
+            await self.task_writes.commit()
+            await self.bot.trade_log.flush()
+
+    def task_tickers(self):
+        """Returns the tickers with price alerts or limit orders. Task workers only return the
+        tickers of the partitions they hold the lease of.
+        """
+        return {t for t in self.bot.alert_index.tickers() | self.bot.order_book.tickers() if self.bot.owns_task(t)}
+
+    async def on_prices(self, quotes: dict):
+        """Checks the tasks of the tickers the PriceHub just refreshed, so that tickers far from a
+        trigger are checked with the hub's prices instead of being fetched again.
+
+        Args:
+            quotes (dict): A dict mapping tickers to their new Quote.
+        """
+        if not self.bot.tasks_watcher.loaded:
+            return
+        tickers = self.task_tickers()
+        quotes = {ticker: quote_data for ticker, quote_data in quotes.items() if ticker in tickers}
+        if not quotes:
+            return
+        now = time.time()
+        await self.check_price_targets(quotes)
+        await self.check_limit_orders(quotes)
+        # Push the next scheduled check of each ticker back, since it was just checked
+        for ticker, quote_data in quotes.items():
+            self.reschedule(ticker, quote_data, now)
+
+    async def check_due_tasks(self):
+        """Checks the tasks of the tickers whose next check is due."""
+        # The alert index and the order book are kept up to date by the Tasks watcher
+        await self.bot.tasks_watcher.wait_until_loaded()
+        now = time.time()
+
+        # Check the tickers of new alerts and orders right away
+        tickers = self.task_tickers()
+        for ticker in tickers - self.scheduler.tickers():
+            self.scheduler.schedule(ticker, now)
+        due = []
+        for ticker in self.scheduler.pop_due(now):
+            if ticker in tickers:
+                due.append(ticker)
+            else:
+                self.scheduler.forget(ticker) # The ticker no longer has any tasks or moved to another worker
+        if not due:
+            return
+
+        # Tickers close to a trigger need a fresh price, the rest can use the PriceHub's
+        near = [t for t in due if (self.scheduler.last_delay(t) or 0) < self.bot.price_hub.refresh_interval]
+        far = [t for t in due if t not in near]
+        quotes = {}
+        if near:
+            quotes.update(await self.bot.price_hub.fetch(near, max_age=self.scheduler.min_interval))
+        if far:
+            quotes.update(await self.bot.price_hub.fetch(far))
+
+        await self.check_price_targets(quotes)
+        await self.check_limit_orders(quotes)
+
+        # Schedule the next check of each ticker based on how close it now is to a trigger
+        for ticker in due:
+            self.reschedule(ticker, quotes.get(ticker), now)
+
+    @check_tasks.before_loop
+    async def before_check_tasks(self):
+        await self.bot.wait_until_ready()
+
+    def reschedule(self, ticker: str, quote_data, now: float):
+        """Schedules the next check of a ticker from its distance to the nearest trigger price and
+        its volatility. Stocks aren't checked again until the market opens if they were checked
+        after it closed, since their prices can't change until then.
+
+        Args:
+            ticker (str): The ticker.
+            quote_data (Quote or dict): The quote the ticker was just checked with, or an error.
+            now (float): The unix timestamp of the check.
+        """
+        # Tickers that couldn't be fetched or whose tasks are all waiting on a DM are checked
+        # again at the maximum staleness
+        distances = []
+        if quote_data is not None and quote_data.get("error") is None:
+            self.scheduler.observe(ticker, quote_data.price, quote_data.as_of)
+            distances = self.bot.alert_index.distances(ticker, quote_data.price) + self.bot.order_book.distances(ticker, quote_data.price)
+        at = now + self.scheduler.delay(ticker, distances)
+        if quote_data is not None and quote_data.get("error") is None and not self.bot.is_crypto(ticker):
+            expiry = market.closed_quote_expiry(quote_data.as_of, now)
+            if expiry is not None:
+                at = max(at, expiry)
+        self.scheduler.schedule(ticker, at)
+
+    async def check_price_targets(self, quotes: dict):
+        """Notifies the users whose price targets have been reached at the given prices.
+
+        Args:
+            quotes (dict): A dict mapping tickers to their Quote or a dict containing an error.
+        """
+        # Find the price targets that have been reached for each ticker
+        reached = []
+        for ticker, quote_data in quotes.items():
+            if quote_data.get("error") is not None:
+                continue
+            reached.extend(self.bot.alert_index.triggered(ticker, quote_data.price))
+
+        # Notify the users whose price targets have been reached
+        await self.price_target_pool.run(reached, self.notify_price_target, key=lambda pt: pt["user_id"])
+
+    async def notify_price_target(self, pt: dict):
+        """Queues a DM to a user that their price target has been reached. The price target is
+        deleted once the DM is sent. Price targets whose ticker moved to another worker since they
+        were checked are left to that worker.
+
+        Returns:
+            bool: Whether a notification was queued.
+        """
+        em = discord.Embed(
+            title=":dart: Price Target Reached",
+            description=f"**`{pt['quote_ticker']}`** has gone `{pt['execute']}` the target price of **`${pt['target_price']}`**",
+            color=discord.Color.green(),
+            timestamp=datetime.datetime.now()
+        )
+
+        # Delete the price target once the user has been notified. If they couldn't be notified
+        # (e.g. a 403 Forbidden error), then do not delete the price target
+        async def on_sent(sent: bool):
+            if sent:
+                self.task_writes.delete(pt["_id"])
+            else:
+                self.bot.alert_index.add(pt)
+
+        # Skip the price target if a concurrent check already took it out of the index, or if the
+        # lease of its ticker was lost while it was checked. Otherwise, take it out so it isn't
+        # triggered again while the DM is queued.
+        if str(pt["_id"]) not in self.bot.alert_index.alerts or not self.bot.owns_task(pt["quote_ticker"]):
+            return False
+        self.bot.alert_index.remove(pt["_id"])
+        self.bot.notifier.notify(pt["user_id"], em, on_sent)
+        return True
     
-    # Create a task to check the database and see if price targets have been reached
-    @tasks.loop(minutes=5)
-    async def check_price_targets(self):
-        cursor = self.bot.tasks.find({"_type": "price_alert"})
-
-        # Loop through each price target searching for ones that have been reached
-        for pt in await cursor.to_list(length=None):
-            quote_data = await self.bot.fetch_quote(pt["quote_ticker"])
-            
-            # Check if the quote has reached the target price
-            reached = False
-            if pt['execute'] == "ABOVE" and float(quote_data["price"]) > pt['target_price']:
-                reached = True
-            elif pt['execute'] == "BELOW" and float(quote_data["price"]) < pt['target_price']:
-                reached = True
-
-            if reached:
-                # Fetch the user and generate the embed
-                user = await self.bot.fetch_user(pt["user_id"])
-                em = discord.Embed(
-                    title=":dart: Price Target Reached",
-                    description=f"**`{pt['quote_ticker']}`** has gone `{pt['execute']}` the target price of **`${pt['target_price']}`**",
-                    color=discord.Color.green(),
-                    timestamp=datetime.datetime.now()
-                )
-                
-                # Try to notify the user about their met price target. If a 403 Forbidden error is
-                # raised, then do not delete the price target
-                try:
-                    await user.send(embeds=[em])
-                    await self.bot.tasks.delete_one(
-                        {
-                            "_id": pt["_id"],
-                        }
-                    )
-                except discord.errors.Forbidden:
-                    print(f"Unable to notify {user.name}#{user.discriminator} about price target on {pt['quote_ticker']} for ${pt['target_price']} (403 Forbidden).")
-            
-            await asyncio.sleep(1) # Prevent Yahoo Finance from ratelimiting the bot
-    
-    @tasks.loop(minutes=5)
-    async def check_limit_orders(self):
-        cursor = self.bot.tasks.find({"_type": "LIMIT_ORDER"})
-
-        # Loop through each limit order searching for ones that need to execute
-        for lo in await cursor.to_list(length=None):
-            quote_data = await self.bot.fetch_brief(lo["ticker"])
-
-            # Check if the order should execute
-            execute = False
-            if lo['limit_order_type'] == "BUY" and float(quote_data["price"]) <= lo['execute_price']:
-                execute = True
-            elif lo['limit_order_type'] == "SELL" and float(quote_data["price"]) >= lo['execute_price']:
-                execute = True
-            
-            if execute:
-                portfolio_data = await self.bot.fetch_portfolio(lo["user_id"])
-                order_total = round(lo['quantity'] * quote_data['price'], 5)
-                
-                # Handle limit BUY orders
-                if lo['limit_order_type'] == "BUY":
-                    # Check if the user has enough money for the order. If they don't, notify them
-                    if order_total > portfolio_data['balance']:
-                        user = await self.bot.fetch_user(lo['user_id'])
-                        em = discord.Embed(
-                            title=f":x: Limit BUY Order Failed for `{lo['ticker']}`",
-                            description=f"Hey {user.name}, you have a pending limit order for `{lo['ticker']}` which has reached it's strike price of `{self.bot.commify(lo['execute_price'])}`, but you don't have enough cash in your portfolio to cover the order total of `${self.bot.commify(order_total)}`.\n\nSell some stocks in order to gain enough money for the order to execute automatically or cancel the pending order.",
-                            color=discord.Color.red(),
-                            timestamp=datetime.datetime.now()
-                        )
-                        try:
-                            # Only notify the user if they haven't been notified before
-                            if lo['notified'] == False:
-                                await user.send(embeds=[em])
-                                lo['notified'] = True
-                                await self.bot.tasks.update_one(
-                                    {"_id": lo["_id"]},
-                                    {"$set": lo}
-                                )
-                        except discord.errors.Forbidden: # User disabled DMs with the bot
-                            print(f"Unable to notify {user.name}#{user.discriminator} about their failed limit BUY on {lo['ticker']} for {lo['quantity']} shares at a strike price of ${lo['execute_price']} (403 Forbidden).")
-                        continue # Move on to the next limit order
-
-                    # Update the user's balance
-                    portfolio_data['balance'] = round(portfolio_data['balance'] - order_total, 3)
-                    # Update the quantity and the buy price if the user already has the quote in their portfolio
-                    for q in portfolio_data["portfolio"]:
-                        if q["ticker"] == lo['ticker']:
-                            q["quantity"] += lo['quantity']
-                            q["buy_price"] = round((q["buy_price"] * q["quantity"] + quote_data["price"] * lo['quantity']) / (q["quantity"] + lo['quantity']), 3)
-                            break
-                    # Otherwise, add the quote to the portfolio in a new entry
-                    else:
-                        portfolio_data["portfolio"].append(
-                            {
-                                "ticker": lo['ticker'],
-                                "quantity": lo['quantity'],
-                                "buy_price": quote_data['price']
-                            }
-                        )
-                    # Update the database with the revised portfolio
-                    await self.bot.portfolio.update_one(
-                        {"_id": lo['user_id']},
-                        {"$set": portfolio_data}
-                    )
-                    await self.bot.log_trade(lo['user_id'], "BUY", lo['ticker'], lo['quantity'], quote_data['price']) # Log the trade in the database as well
-                    await self.bot.tasks.delete_one({"_id": lo["_id"]})
-
-                # Handle limit SELL orders
-                elif lo['limit_order_type'] == "SELL":
-                    # Reduce the number of shares the user has in their portfolio. While updating
-                    # the number of shares the user has, make sure they have enough shares for the
-                    # order to be placed, otherwise, notify them.
-                    failure = False
-                    for q in portfolio_data['portfolio']:
-                        if q["ticker"] == lo['ticker']:
-                            if q["quantity"] < lo["quantity"]:
-                                failure = True
-                            else:
-                                q["quantity"] -= lo["quantity"]
-                                if q["quantity"] == 0:
-                                    portfolio_data["portfolio"].remove(q)
-                            break
-                    else:
-                        self.bot.tasks.delete_one({"_id": lo['_id']}) # Delete the limit order since the user already sold all of their shares of the quote
-                        continue # Move on to the next limit order
-                    # Check if the order failed. If it did, then notify the user about it
-                    if failure:
-                        user = await self.bot.fetch_user(lo['user_id'])
-                        em = discord.Embed(
-                            title=f":x: Limit SELL Order Failed for `{lo['ticker']}`",
-                            description=f"Hi {user.name}, your order was unable to execute successfully because you don't own at least `{self.bot.commify(lo['quantity'])}` shares of `{lo['ticker']}` to sell at a strike price of `${self.bot.commify(lo['execute_price'])}`.\n\nBuy at least `{self.bot.commify(lo['quantity'] - q['quantity'])}` more shares of `{lo['ticker']}` for the limit order to execute automatically or delete the pending order.",
-                            color=discord.Color.red(),
-                            timestamp=datetime.datetime.now()
-                        )
-                        try:
-                            # Only notify the user if they haven't been notified before
-                            if lo['notified'] == False:
-                                await user.send(embeds=[em])
-                                lo['notified'] = True
-                                await self.bot.tasks.update_one(
-                                    {"_id": lo["_id"]},
-                                    {"$set": lo}
-                                )
-                        except discord.errors.Forbidden: # User has DMs disabled
-                            print(f"Unable to notify {user.name}#{user.discriminator} about their failed limit SELL order on {lo['ticker']} for {lo['quantity']} shares at a strike price of ${lo['strike_price']} (403 Forbidden).")
-                        continue # Move on to the next order
-                    # Order succeeded, so increase the user's balance and update the database
-                    else:
-                        portfolio_data['balance'] = round(portfolio_data['balance'] + order_total, 3)
-                        await self.bot.portfolio.update_one(
-                            {"_id": lo['user_id']},
-                            {"$set": portfolio_data}
-                        )
-                        await self.bot.log_trade(lo['user_id'], "SELL", lo['ticker'], lo['quantity'], quote_data['price'])
-                        await self.bot.tasks.delete_one({"_id": lo["_id"]})
-
-                # Send the user a DM that their order was successful
-                user = await self.bot.fetch_user(lo["user_id"])
-                em = discord.Embed(
-                    title=":moneybag: Limit Order Executed",
-                    description=f"Your limit **`{lo['limit_order_type']}`** on **`{lo['ticker']}`** for `{self.bot.commify(lo['quantity'])}` shares has been executed at **`${self.bot.commify(quote_data['price'])}`**. The total {'cost' if lo['limit_order_type'] == 'BUY' else 'profit'} was **`${self.bot.commify(order_total)}`**.\n\n:dollar: You now have **`${self.bot.commify(portfolio_data['balance'])}`** of cash.",
-                    color=discord.Color.green(),
+    async def check_limit_orders(self, quotes: dict):
+        """Executes the limit orders that are marketable at the given prices.
+
+        Args:
+            quotes (dict): A dict mapping tickers to their Quote or a dict containing an error.
+        """
+        # Pop the orders that can execute at the current price of each ticker
+        marketable = []
+        for ticker, quote_data in quotes.items():
+            if quote_data.get("error") is not None:
+                continue
+            marketable.extend((lo, quote_data) for lo in self.bot.order_book.pop_marketable(ticker, quote_data.price))
+
+        # Try to execute the marketable orders. Orders that aren't executed are put back in the order book.
+        _, carried = await self.limit_order_pool.run(marketable, lambda order: self.execute_limit_order(*order), key=lambda order: order[0]["user_id"])
+        for lo, _ in carried:
+            self.bot.order_book.add(lo)
+
+    async def execute_limit_order(self, lo: dict, quote_data: Quote):
+        """Executes a limit order that is marketable at a price, or notifies the user if it fails.
+        The order is claimed with an atomic update first, so only one process executes it, and
+        orders whose ticker moved to another worker since they were popped are left to it. Orders
+        that can't be executed yet are released so they rest again, and filled orders are deleted
+        right away. A claim that is never released, e.g. because the process stopped, goes stale
+        after a while and the order can be claimed again.
+
+        Args:
+            lo (dict): The limit order.
+            quote_data (Quote): The current quote of the order's ticker.
+
+        Returns:
+            bool: Whether the order was executed.
+        """
+        # Leave the order to the worker that took over its ticker's lease while it was popped
+        if not self.bot.owns_task(lo["ticker"]):
+            self.bot.order_book.add(lo)
+            return False
+
+        # Claim the order. An order with a live claim is being executed by another attempt.
+        now = time.time()
+        claim = await self.bot.tasks.find_one_and_update(
+            {"_id": lo["_id"], "$or": [{"claimed_by": {"$exists": False}}, {"claimed_at": {"$lt": now - self.order_claim_ttl}}]},
+            {"$set": {"claimed_by": Config.WORKER_ID, "claimed_at": now}},
+            projection={"_id": 1}
+        )
+        if claim is None:
+            # Keep the order resting if it still exists, so it's claimed once the claim goes stale
+            if str(lo["_id"]) in self.bot.tasks_watcher.documents:
+                self.bot.order_book.add(lo)
+            return False
+
+        order_total = round(lo['quantity'] * quote_data.price, 5)
+        try:
+            new_balance = await self.fill_limit_order(lo, quote_data, order_total)
+        except Exception:
+            # Release the order so it's tried again. The pool reports the error and puts the order
+            # back in the book.
+            await self.release_limit_order(lo)
+            raise
+        if new_balance is None:
+            return False
+
+        # Delete the order right away. If that fails, the delete is retried with the task writes
+        # and the claim keeps the order from being executed again in the meantime.
+        try:
+            await self.bot.tasks.delete_one({"_id": lo["_id"]})
+            self.bot.tasks_watcher.forget(lo["_id"])
+        except pymongo.errors.PyMongoError as e:
+            print(f"Failed to delete the executed limit order {lo['_id']}, retrying with the task writes\n{e.__class__.__name__}: {e}")
+            self.task_writes.delete(lo["_id"])
+
+        # Queue a DM telling the user that their order was successful
+        em = discord.Embed(
+            title=":moneybag: Limit Order Executed",
+            description=f"Your limit **`{lo['limit_order_type']}`** on **`{lo['ticker']}`** for `{self.bot.commify(lo['quantity'])}` shares has been executed at **`${self.bot.commify(quote_data.price)}`**. The total {'cost' if lo['limit_order_type'] == 'BUY' else 'profit'} was **`${self.bot.commify(order_total)}`**.\n\n:dollar: You now have **`${self.bot.commify(new_balance)}`** of cash.",
+            color=discord.Color.green(),
+            timestamp=datetime.datetime.now()
+        )
+        self.bot.notifier.notify(lo["user_id"], em)
+        return True
+
+    async def fill_limit_order(self, lo: dict, quote_data: Quote, order_total: float):
+        """Makes the trade of a claimed limit order. If the user can't afford it or doesn't have
+        enough shares, they are notified and the order is released to rest until they can.
+
+        Args:
+            lo (dict): The limit order.
+            quote_data (Quote): The current quote of the order's ticker.
+            order_total (float): The total cost or profit of the order.
+
+        Returns:
+            float: The user's new balance or None if the order wasn't filled.
+        """
+        # Handle limit BUY orders
+        if lo['limit_order_type'] == "BUY":
+            # Update the user's balance, holding and trade history in one atomic update. It only
+            # applies if the user has enough money for the order. If they don't, notify them
+            new_balance = await self.bot.buy_shares(lo['user_id'], lo['ticker'], lo['quantity'], quote_data.price, cost=order_total)
+            if new_balance is None:
+                # Only notify the user if they haven't been notified before
+                notify = lo['notified'] == False
+                if notify:
+                    self.bot.notifier.notify(lo['user_id'], lambda user: discord.Embed(
+                        title=f":x: Limit BUY Order Failed for `{lo['ticker']}`",
+                        description=f"Hey {user.name}, you have a pending limit order for `{lo['ticker']}` which has reached it's strike price of `{self.bot.commify(lo['execute_price'])}`, but you don't have enough cash in your portfolio to cover the order total of `${self.bot.commify(order_total)}`.\n\nSell some stocks in order to gain enough money for the order to execute automatically or cancel the pending order.",
+                        color=discord.Color.red(),
+                        timestamp=datetime.datetime.now()
+                    ))
+                await self.release_limit_order(lo, notified=notify)
+                self.bot.order_book.add(lo) # Keep the order resting until the user can afford it
+            return new_balance
+
+        # Handle limit SELL orders
+        # Update the user's balance, holding and trade history in one atomic update. It only
+        # applies if the user has enough shares for the order, otherwise, notify them.
+        new_balance = await self.bot.sell_shares(lo['user_id'], lo['ticker'], lo['quantity'], quote_data.price)
+        # Check if the order failed. If it did, then notify the user about it
+        if new_balance is None:
+            portfolio_data = await self.bot.fetch_holdings(lo['user_id'])
+            q = next((q for q in (portfolio_data or {}).get('portfolio', []) if q["ticker"] == lo['ticker']), None)
+            if q is None:
+                # Delete the limit order since the user already sold all of their shares of the quote
+                await self.bot.tasks.delete_one({"_id": lo["_id"]})
+                self.bot.tasks_watcher.forget(lo["_id"])
+                return None
+            # Only notify the user if they haven't been notified before
+            notify = lo['notified'] == False
+            if notify:
+                self.bot.notifier.notify(lo['user_id'], lambda user: discord.Embed(
+                    title=f":x: Limit SELL Order Failed for `{lo['ticker']}`",
+                    description=f"Hi {user.name}, your order was unable to execute successfully because you don't own at least `{self.bot.commify(lo['quantity'])}` shares of `{lo['ticker']}` to sell at a strike price of `${self.bot.commify(lo['execute_price'])}`.\n\nBuy at least `{self.bot.commify(lo['quantity'] - q['quantity'])}` more shares of `{lo['ticker']}` for the limit order to execute automatically or delete the pending order.",
+                    color=discord.Color.red(),
                     timestamp=datetime.datetime.now()
-                )
-                try:
-                    await user.send(embeds=[em])
-                except discord.errors.Forbidden: # User has DMs disabled
-                    print(f"Unable to notify {user.name}#{user.discriminator} about successful {lo['limit_order_type']} limit order on {lo['ticker']} for {lo['quantity']} shares at a strike price of ${lo['strike_price']} (403 Forbidden).")
+                ))
+            await self.release_limit_order(lo, notified=notify)
+            self.bot.order_book.add(lo) # Keep the order resting until the user has enough shares
+        return new_balance
 
-            await asyncio.sleep(1) # Prevent ratelimits
+    async def release_limit_order(self, lo: dict, notified: bool = False):
+        """Releases the claim of a limit order that wasn't executed. If the release fails, it's
+        retried with the task writes, and the claim goes stale if the process stops first.
 
+        Args:
+            lo (dict): The limit order.
+            notified (bool, optional): Whether the user was just notified that the order failed.
+        """
+        update = {"$unset": {"claimed_by": "", "claimed_at": ""}}
+        if notified:
+            lo['notified'] = True
+            update["$set"] = {"notified": True}
+        try:
+            await self.bot.tasks.update_one({"_id": lo["_id"]}, update)
+        except pymongo.errors.PyMongoError as e:
+            print(f"Failed to release the limit order {lo['_id']}, retrying with the task writes\n{e.__class__.__name__}: {e}")
+            self.task_writes.update(lo["_id"], update)
 
 def setup(bot):
     bot.add_cog(TaskManager(bot))
\ No newline at end of file
@@ -4,13 +4,16 @@ from discord.ext import commands
 from discord.ext import tasks
 
 import aiohttp
+import asyncio
 import json
+import pymongo.errors
 import random
 import datetime
 import time
 
 from extras import *
 from config import Config
+from server import set_vote_listener
 
 
 class Utils(commands.Cog, name="Utility Commands"):
@@ -19,9 +22,27 @@ class Utils(commands.Cog, name="Utility Commands"):
         self.bot: ProfitGreenBot = bot
         self.topgg_api = "https://top.gg/api"
 
-        if Config.PRODUCTION:
+        # Only the bot posts the server count, since task workers aren't in any servers
+        if Config.PRODUCTION and not self.bot.worker:
             self.update_stats.start()
-            self.parse_votes.start()
+        # Reward votes as soon as they arrive. Votes are queued by the webhook when it runs in this
+        # process, and by the Tasks watcher, which also replays the votes left in the database.
+        self.votes = asyncio.Queue()
+        self._queued_votes = set()
+        self._retried_votes = set()
+        self.vote_claim_ttl = 5 * 60 # The number of seconds a vote is claimed for while it's rewarded
+        self.bot.tasks_watcher.register("upvote", self.queue_vote, lambda _id: None)
+        self.bot.delayed_jobs.register("upvote_reminder", self.send_reminder)
+        if self.bot.partitions is not None:
+            self.bot.partitions.subscribe(lambda partitions: self.replay_votes())
+
+        # Reward votes here unless they are left to the task workers
+        if self.bot.runs_tasks:
+            if not self.bot.worker:
+                set_vote_listener(self.bot.loop, self.queue_vote)
+            self.bot.tasks_watcher.start()
+            self.reward_votes.start()
+            self.bot.delayed_jobs.start()
 
         # Cog data
         self.emoji = ":gear:"
@@ -29,7 +50,8 @@ class Utils(commands.Cog, name="Utility Commands"):
     def cog_unload(self):
         """Cancels all tasks when cog is unloaded"""
         self.update_stats.stop()
-        self.parse_votes.stop()
+        self.reward_votes.cancel()
+        set_vote_listener(None, None)
     
     @commands.Cog.listener()
     async def on_ready(self):
@@ -46,8 +68,7 @@ class Utils(commands.Cog, name="Utility Commands"):
             payload = {
                 "server_count": 10497 # Fake server count
             }
-            async with aiohttp.ClientSession(json_serialize=json.dumps) as session:
-                await session.post(url, data=payload, headers=headers)
+            await self.bot.http_request("topgg", "POST", url, response_type="text", data=payload, headers=headers)
             print("Posted server count to Top.gg")
         except Exception as e:
             print(f"Failed to post server count\n{e.__class__.__name__}: {e}")
@@ -57,92 +78,192 @@ class Utils(commands.Cog, name="Utility Commands"):
         """Wait until the bot is ready before the task starts."""
         await self.bot.wait_until_ready()
     
-    @tasks.loop(seconds=5)
-    async def parse_votes(self):
-        # Fetch all the upvotes from the tasks collection
-        cursor = self.bot.tasks.find({"_type": "upvote"})
-        for vote in await cursor.to_list(length=None):
-            # Fetch the user and create a portfolio for them if they don't have one
-            user = await self.bot.fetch_user(vote["user"])
-            await self.bot.create_portfolio(user)
-            await self.bot.tasks.delete_one(vote) # Remove the vote task
-            # Fetch the stock and calculate the data associated with it
-            stock = random.choice(list(self.bot.reward_stocks.keys()))
-            stock_data = await self.bot.cnbc_data(stock)
-            price = stock_data["price"]
-            shares = self.bot.reward_stocks[stock]
-            total = round(price * shares, 2)
-            # Add the stock to the user's portfolio
-            portfolio = await self.bot.fetch_portfolio(user.id)
-            for i, q in enumerate(portfolio["portfolio"]):
-                if q["ticker"] == stock:
-                    portfolio["portfolio"][i]["buy_price"] = round((q["buy_price"] * q["quantity"] + total) / (q["quantity"] + shares), 2)
-                    portfolio["portfolio"][i]["quantity"] += shares
-                    break
-            else:
-                portfolio["portfolio"].append({
-                    "ticker": stock,
-                    "quantity": shares,
-                    "buy_price": price
-                })
-            await self.bot.portfolio.update_one({"_id": user.id}, {"$set": portfolio})
-            await self.bot.log_trade(user.id, "BUY", stock, shares, price, vote_reward=True) # Log the trade in the database
-            # Notify the user
-            em = discord.Embed(
-                title=":gem: Here is Your Vote Reward!",
-                description=f"""
-                Hey `{user.name}`, you just received `{shares}` shares of `{stock}` worth `${total}`!
-
-                :heart: Thanks for voting!
-                """,
+    def queue_vote(self, vote: dict):
+        """Queues a vote task to be rewarded. Votes of other workers' users and votes that are
+        already queued are skipped.
+
+        Args:
+            vote (dict): The upvote task.
+        """
+        if not self.bot.owns_task(vote["user"]) or str(vote["_id"]) in self._queued_votes:
+            return
+        self._queued_votes.add(str(vote["_id"]))
+        self.votes.put_nowait(vote)
+
+    def retry_vote(self, vote: dict, at: float):
+        """Queues a vote again at a time, e.g. once the claim of a failed attempt expires.
+
+        Args:
+            vote (dict): The upvote task.
+            at (float): The unix timestamp the vote is queued at.
+        """
+        key = str(vote["_id"])
+        if key in self._retried_votes:
+            return
+        self._retried_votes.add(key)
+
+        def retry():
+            self._retried_votes.discard(key)
+            self.queue_vote(vote)
+
+        self.bot.loop.call_later(max(0, at - time.time()), retry)
+
+    def replay_votes(self):
+        """Queues the votes in the in-memory copy of the tasks collection, e.g. the votes of
+        partitions this worker just took over.
+        """
+        for vote in self.bot.tasks_watcher.find("upvote"):
+            self.queue_vote(vote)
+
+    @tasks.loop(seconds=0)
+    async def reward_votes(self):
+        vote = await self.votes.get()
+        try:
+            await self.reward_vote(vote)
+        except Exception as e:
+            print(f"Failed to reward the vote of {vote['user']}\n{e.__class__.__name__}: {e}")
+            self.retry_vote(vote, time.time() + self.vote_claim_ttl) # Once its claim expires
+        finally:
+            self._queued_votes.discard(str(vote["_id"]))
+
+    @reward_votes.before_loop
+    async def before_reward_votes(self):
+        """Replays the votes that weren't rewarded before the bot restarted."""
+        await self.bot.wait_until_ready()
+        await self.bot.tasks_watcher.wait_until_loaded()
+        self.replay_votes()
+        await self.migrate_reminders()
+
+    async def reward_vote(self, vote: dict):
+        """Gives a user their vote reward and logs the vote. The vote is claimed for a while first,
+        so that only one attempt rewards it, and it's marked as rewarded with a conditional update
+        right before the trade, so that a vote whose deletion fails is never rewarded twice. If the
+        reward fails, the vote is retried once the claim expires.
+
+        Args:
+            vote (dict): The upvote task.
+        """
+        # Claim the vote. Skip it if it was already rewarded or another attempt is rewarding it.
+        now = time.time()
+        claimed_until = now + self.vote_claim_ttl
+        claim = await self.bot.tasks.find_one_and_update(
+            {"_id": vote["_id"], "$or": [{"claimed_until": {"$exists": False}}, {"claimed_until": {"$lt": now}}]},
+            {"$set": {"claimed_until": claimed_until}},
+            projection={"_id": 1, "rewarded": 1}
+        )
+        if claim is None:
+            # Try again once the other attempt's claim expires, in case it fails
+            current = await self.bot.tasks.find_one({"_id": vote["_id"]}, {"claimed_until": 1})
+            if current is not None:
+                self.retry_vote(vote, current.get("claimed_until", now))
+            return
+        # The vote was rewarded by an attempt that failed to delete it
+        if claim.get("rewarded"):
+            await self.bot.tasks.delete_one({"_id": vote["_id"]})
+            self.bot.tasks_watcher.forget(vote["_id"])
+            return
+
+        # Fetch the user and create a portfolio for them if they don't have one
+        try:
+            user = await self.bot.resolve_user(vote["user"])
+        except discord.errors.NotFound:
+            # There is no one to reward
+            await self.bot.tasks.delete_one({"_id": vote["_id"]})
+            self.bot.tasks_watcher.forget(vote["_id"])
+            return
+        except discord.errors.HTTPException as e:
+            print(f"Failed to fetch the user {vote['user']} to reward their vote, retrying later\n{e.__class__.__name__}: {e}")
+            self.retry_vote(vote, claimed_until)
+            return
+        await self.bot.create_portfolio(user)
+        # Fetch the stock and calculate the data associated with it
+        stock = random.choice(list(self.bot.reward_stocks.keys()))
+        stock_data = await self.bot.cnbc_data(stock)
+        if stock_data.get("error") is not None:
+            print(f"Failed to fetch {stock} to reward the vote of {vote['user']}, retrying later\n{stock_data['error']}")
+            self.retry_vote(vote, claimed_until)
+            return
+        price = stock_data.price
+        shares = self.bot.reward_stocks[stock]
+        total = round(price * shares, 2)
+        # Mark the vote as rewarded while this attempt still holds the claim. If the trade raises,
+        # it may have been applied, so the vote stays marked rather than risk rewarding it twice.
+        result = await self.bot.tasks.update_one(
+            {"_id": vote["_id"], "claimed_until": claimed_until, "rewarded": {"$exists": False}},
+            {"$set": {"rewarded": True}}
+        )
+        if result.modified_count == 0:
+            return # The claim expired and another attempt took over
+        # Add the stock to the user's portfolio for free and log the trade in one atomic update
+        if await self.bot.buy_shares(user.id, stock, shares, price, cost=0, vote_reward=True) is None:
+            print(f"Failed to give {user.id} their vote reward, retrying later")
+            await self.bot.tasks.update_one({"_id": vote["_id"]}, {"$unset": {"rewarded": ""}})
+            self.retry_vote(vote, claimed_until)
+            return
+        # Remove the vote task now that it has been rewarded. If that fails, the retry deletes it.
+        try:
+            await self.bot.tasks.delete_one({"_id": vote["_id"]})
+            self.bot.tasks_watcher.forget(vote["_id"])
+        except pymongo.errors.PyMongoError as e:
+            print(f"Failed to delete the rewarded vote of {user.id}, retrying later\n{e.__class__.__name__}: {e}")
+            self.retry_vote(vote, claimed_until)
+        self.bot.price_hub.track(stock)
+        # Notify the user
+        em = discord.Embed(
+            title=":gem: Here is Your Vote Reward!",
+            description=f"""
+            Hey `{user.name}`, you just received `{shares}` shares of `{stock}` worth `${total}`!
+
+            :heart: Thanks for voting!
+            """,
+            timestamp=datetime.datetime.now(),
+            color=self.bot.green
+        )
+        self.bot.notifier.notify(user.id, em)
+        # Log the vote in the bot's log channel
+        if user.id != self.bot.owner_id:
+            # Get the total number of votes
+            url = f"{self.topgg_api}/bots/{self.bot.user.id}/votes"
+            headers = {
+                "Authorization": self.bot.topgg_token
+            }
+            data = await self.bot.http_request("topgg", "GET", url, headers=headers)
+            vote_len = len(data)
+            log_em = discord.Embed(
+                title=f":gem: `{user.name}#{user.discriminator}` Just Voted!",
+                description=f"{self.bot._emojis['profitgreen']} We now have `{vote_len}` votes!",
                 timestamp=datetime.datetime.now(),
                 color=self.bot.green
             )
-            try:
-                await user.send(embeds=[em])
-            except discord.errors.Forbidden: # User has DMs disabled
-                pass
-            # Log the vote in the bot's log channel
-            if user.id != self.bot.owner_id:
-                # Get the total number of votes
-                url = f"{self.topgg_api}/bots/{self.bot.user.id}/votes"
-                headers = {
-                    "Authorization": self.bot.topgg_token
-                }
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers) as r:
-                        data = await r.json()
-                        vote_len = len(data)
-                log_em = discord.Embed(
-                    title=f":gem: `{user.name}#{user.discriminator}` Just Voted!",
-                    description=f"{self.bot._emojis['profitgreen']} We now have `{vote_len}` votes!",
-                    timestamp=datetime.datetime.now(),
-                    color=self.bot.green
-                )
-                log_channel = self.bot.get_channel(self.bot.log_channels[0])
-                await log_channel.send(embeds=[log_em])
-        # Fetch all upvote_reminders from the tasks collection
-        cursor = self.bot.tasks.find({"_type": "upvote_reminder"})
-        for reminder in await cursor.to_list(length=None):
-            if reminder['remind_timestamp'] < time.time(): # Make sure that the time for the reminder to execute has already passed
-                user = await self.bot.fetch_user(reminder['user'])
-                em = discord.Embed(
-                    title=":calendar_spiral: Upvote Reminder",
-                    description=f"Hey `{user.name}`, you can vote for me again on Top.gg!\n\n{self.bot._emojis['profitgreen']} Here's the link to vote: https://top.gg/bot/{self.bot.user.id}/vote",
-                    color=self.bot.green,
-                    timestamp=datetime.datetime.now()
-                )
-                # Send the user the previously created embed
-                try:
-                    await user.send(embeds=[em])
-                except: # User has DMs disabled
-                    pass
-                await self.bot.tasks.delete_one(reminder) # Delete the reminder task
-
-    @parse_votes.before_loop
-    async def before_parse_votes(self):
+            # Task workers have no channel cache, so they fetch the channel
+            log_channel = self.bot.get_channel(self.bot.log_channels[0]) or await self.bot.fetch_channel(self.bot.log_channels[0])
+            await log_channel.send(embeds=[log_em])
+
+    async def send_reminder(self, job: dict):
+        """Queues an upvote reminder. It is only attempted once, so the job is done once it is queued.
+
+        Args:
+            job (dict): The upvote_reminder job.
+        """
         await self.bot.wait_until_ready()
-    
+        self.bot.notifier.notify(job["data"]["user"], lambda user: discord.Embed(
+            title=":calendar_spiral: Upvote Reminder",
+            description=f"Hey `{user.name}`, you can vote for me again on Top.gg!\n\n{self.bot._emojis['profitgreen']} Here's the link to vote: https://top.gg/bot/{self.bot.user.id}/vote",
+            color=self.bot.green,
+            timestamp=datetime.datetime.now()
+        ))
+
+    async def migrate_reminders(self):
+        """Moves the upvote reminders left in the Tasks collection to the Jobs collection."""
+        for reminder in self.bot.tasks_watcher.find("upvote_reminder"):
+            await self.bot.jobs.update_one(
+                {"_id": reminder["_id"]},
+                {"$setOnInsert": {"job": "upvote_reminder", "due_at": reminder["remind_timestamp"], "data": {"user": reminder["user"]}}},
+                upsert=True
+            )
+            await self.bot.tasks.delete_one({"_id": reminder["_id"]})
+            self.bot.tasks_watcher.forget(reminder["_id"])
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         # No longer in use due to this being turned into a message command
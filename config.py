@@ -1,5 +1,6 @@
 import os
 import ast
+import socket
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -19,4 +20,21 @@ class Config:
     PRODUCTION = ast.literal_eval(os.getenv('PRODUCTION')) # Convert to boolean
     PORT = int(os.getenv('PORT'))
     DB_CONNECTION_STRING = os.getenv('DB_CONNECTION_STRING')
-    ALPHA_VANTAGE_API_KEY = os.getenv('ALPHA_VANTAGE_API_KEY')
\ No newline at end of file
+    INDEX_TEST_DB_CONNECTION_STRING = os.getenv('INDEX_TEST_DB_CONNECTION_STRING', 'mongodb://localhost:27017') # Local database that indexes.py checks the query shapes against
+    ALPHA_VANTAGE_API_KEY = os.getenv('ALPHA_VANTAGE_API_KEY')
+    # Record or replay upstream responses for offline benchmarking ("record", "replay" or unset)
+    FIXTURE_MODE = os.getenv('FIXTURE_MODE') or None
+    FIXTURE_PATH = os.getenv('FIXTURE_PATH', 'fixtures.json.gz')
+    FIXTURE_LATENCY = float(os.getenv('FIXTURE_LATENCY', '0')) # Average seconds of latency added to replayed responses
+    FIXTURE_ERROR_RATE = float(os.getenv('FIXTURE_ERROR_RATE', '0')) # Chance from 0 to 1 that a replayed request fails
+    # Task evaluation in the TaskManager loops
+    TASK_CONCURRENCY = int(os.getenv('TASK_CONCURRENCY', '8')) # Maximum number of tasks handled at the same time
+    TASK_MIN_INTERVAL = float(os.getenv('TASK_MIN_INTERVAL', '5')) # Minimum seconds between checks of a ticker's tasks
+    TASK_CYCLE_DEADLINE = float(os.getenv('TASK_CYCLE_DEADLINE', str(TASK_MIN_INTERVAL * 2))) # Seconds after which a cycle stops starting new tasks, so a slow cycle doesn't hold back the next checks
+    TASK_MAX_STALENESS = float(os.getenv('TASK_MAX_STALENESS', '300')) # Maximum seconds between checks of a ticker's tasks
+    # Task workers (worker.py) that run the background tasks outside of the bot process
+    TASK_WORKERS = ast.literal_eval(os.getenv('TASK_WORKERS', 'False')) # Whether the bot leaves the background tasks to task workers
+    WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}" # Unique id of a task worker
+    WORKER_PARTITIONS = int(os.getenv('WORKER_PARTITIONS', '16')) # Number of partitions the tasks are split into, the same for every worker
+    WORKER_LEASE_TTL = float(os.getenv('WORKER_LEASE_TTL', '30')) # Seconds before the partitions of a worker that stopped are taken over
+    TRADE_QUOTE_MAX_AGE = float(os.getenv('TRADE_QUOTE_MAX_AGE', '5')) # Maximum age in seconds of the quotes that trades and orders are placed at
\ No newline at end of file
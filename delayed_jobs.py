@@ -0,0 +1,171 @@
+from discord.ext import tasks
+import pymongo
+import pymongo.errors
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from indexes import query_shape
+
+
+class DelayedJobs:
+    """Runs jobs at a set time, such as upvote reminders. Jobs are stored in the Jobs collection so
+    they survive restarts, and the jobs that are due within the next window are kept in a min-heap
+    by due time. The window is reloaded with one range query on the indexed due_at field, so the
+    work done scales with the number of jobs that are about to be due rather than the number of
+    pending jobs.
+
+    Before a job runs it is claimed for a while, so that only one process runs it even if several
+    load it. The job is deleted once its handler finishes. If the process stops in between, the
+    claim expires and the job runs on the next reload.
+
+    Job document:
+    {
+        "_id": ObjectID("5e9f8f8f8f8f8f8f8f8f8f8"),
+        "job": "upvote_reminder",
+        "due_at": 123412341234,
+        "data": {"user": "81234818238418324"},
+        "claimed_until": 123412341294 # Only set while the job is running
+    }
+    """
+
+    def __init__(self, collection, window: float = 5 * 60, claim_ttl: float = 60):
+        """
+        Args:
+            collection (motor.motor_asyncio.AsyncIOMotorCollection): The Jobs collection.
+            window (float, optional): The number of seconds between reloads of the jobs that are
+                due soon. Each reload loads the jobs due within two windows.
+            claim_ttl (float, optional): The number of seconds a job is claimed for while it runs.
+        """
+        self.collection = collection
+        self.window = window
+        self.claim_ttl = claim_ttl
+        self.fired = 0
+        self.failed = 0
+        self._handlers = {} # job name -> coroutine function called with the job document
+        self._heap = [] # (due_at, sequence number, job _id)
+        self._jobs = {} # job _id -> job document
+        self._sequence = itertools.count()
+        self._next_reload = 0
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def start(self):
+        if not self.run.is_running():
+            self.run.start()
+
+    def stop(self):
+        self.run.cancel()
+
+    def register(self, job: str, handler):
+        """Registers the coroutine function that runs the jobs with a name. It is called with the
+        job document.
+        """
+        self._handlers[job] = handler
+
+    async def schedule(self, job: str, due_at: float, data: dict = None):
+        """Stores a job and schedules it.
+
+        Args:
+            job (str): The name of the job's handler.
+            due_at (float): The unix timestamp the job runs at.
+            data (dict, optional): The data passed to the handler.
+
+        Returns:
+            ObjectId: The _id of the job.
+        """
+        doc = {"job": job, "due_at": due_at, "data": data or {}}
+        await self.collection.insert_one(doc)
+        self._push(doc)
+        return doc["_id"]
+
+    async def cancel(self, _id):
+        """Deletes a job so it never runs."""
+        await self.collection.delete_one({"_id": _id})
+        self._jobs.pop(_id, None)
+
+    def _push(self, doc: dict):
+        """Adds a job to the heap if it is due before the next reload. Later jobs are loaded then."""
+        if doc["_id"] in self._jobs or doc["due_at"] > self._next_reload + self.window:
+            return
+        self._jobs[doc["_id"]] = doc
+        heapq.heappush(self._heap, (doc["due_at"], next(self._sequence), doc["_id"]))
+        self._wakeup.set()
+
+    @query_shape("Jobs", {"due_at": {"$lte": 0}}, [("due_at", pymongo.ASCENDING)])
+    async def reload(self, now: float):
+        """Loads the jobs that are due within the next two windows, including jobs whose claim
+        expired without them finishing.
+        """
+        self._next_reload = now + self.window
+        cursor = self.collection.find({"due_at": {"$lte": now + 2 * self.window}}).sort("due_at", pymongo.ASCENDING)
+        async for doc in cursor:
+            if doc.get("claimed_until", 0) < now:
+                self._push(doc)
+
+    async def _claim(self, doc: dict, now: float):
+        """Claims a job so that no other process runs it at the same time.
+
+        Returns:
+            bool: Whether the job was claimed.
+        """
+        result = await self.collection.update_one(
+            {"_id": doc["_id"], "$or": [{"claimed_until": {"$exists": False}}, {"claimed_until": {"$lt": now}}]},
+            {"$set": {"claimed_until": now + self.claim_ttl}}
+        )
+        return result.modified_count == 1
+
+    async def fire(self, doc: dict, now: float):
+        """Claims a job, runs its handler and deletes it. A job whose handler fails is left to run
+        again once its claim expires.
+        """
+        handler = self._handlers.get(doc["job"])
+        if handler is None:
+            print(f"No handler is registered for the {doc['job']} job {doc['_id']}")
+            return
+        if not await self._claim(doc, now):
+            return
+        try:
+            await handler(doc)
+        except Exception as e:
+            self.failed += 1
+            print(f"The {doc['job']} job {doc['_id']} failed\n{e.__class__.__name__}: {e}")
+            return
+        await self.collection.delete_one({"_id": doc["_id"]})
+        self.fired += 1
+
+    @tasks.loop(seconds=0)
+    async def run(self):
+        # Jobs scheduled from now on wake the loop up again
+        self._wakeup.clear()
+        now = time.time()
+        if now >= self._next_reload:
+            try:
+                await self.reload(now)
+            except pymongo.errors.PyMongoError as e:
+                self._next_reload = now + self.claim_ttl # Try again soon
+                print(f"Failed to load the delayed jobs\n{e.__class__.__name__}: {e}")
+
+        # Run the jobs that are due
+        while self._heap and self._heap[0][0] <= now:
+            _, _, _id = heapq.heappop(self._heap)
+            doc = self._jobs.pop(_id, None)
+            if doc is None:
+                continue # The job was cancelled
+            try:
+                await self.fire(doc, now)
+            except pymongo.errors.PyMongoError as e:
+                print(f"Failed to run the {doc['job']} job {doc['_id']}\n{e.__class__.__name__}: {e}")
+
+        # Sleep until the next job is due, a job is scheduled or the next reload
+        timeout = self._next_reload - time.time()
+        if self._heap:
+            timeout = min(timeout, self._heap[0][0] - time.time())
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), max(0, timeout))
+        except asyncio.TimeoutError:
+            pass
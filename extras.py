@@ -8,59 +8,446 @@ import csv
 import asyncio
 import sqlite3
 import functools
+import inspect
 import ssl
 import time
 import random
-import cnbcfinance
 import motor.motor_asyncio
+from pymongo import ReturnDocument
 from bs4 import BeautifulSoup
+from collections import OrderedDict
 from decimal import Decimal
 
+import market
+from alert_index import AlertIndex
+from order_book import OrderBook
 from config import Config
+from delayed_jobs import DelayedJobs
+from fixtures import FixtureArchive
+from indexes import ensure_indexes, query_shape
+from notifier import Notifier
+from price_hub import PriceHub
+from quotes import Quote, format_number
+from providers import ProviderHealth, TokenBucket, hedged_request, timed_request
+from sharding import PartitionLeases
+from tasks_watcher import TasksWatcher
+from trade_log import TradeLog
 
 
 def insensitive_ticker(func):
-    """A decorator that adds -USD to quote_ticker if it is needed for the function.
+    """A decorator that adds -USD to quote_ticker if it is needed for the function. The form of the
+    ticker that worked is remembered by the bot's TickerResolver so that repeat lookups only need one
+    request, and tickers that couldn't be found either way are briefly cached as invalid.
     """
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        output = await func(*args, **kwargs)
-        if output.get("error") is not None:
-            # Store the original list of similar tickers if the error is a 404 error
-            if output.get("error_code") == 404:
-                similar_tickers = output.get("similar_tickers")
-            # Handle the ticker being an arg
-            if kwargs.get("quote_ticker") is None:
-                args = list(args)
-                if "-" in args[1]:
-                    args[1] = args[1].split("-")[0]
-                else:
-                    args[1] = args[1] + "-USD"
-                args = tuple(args)
-            # Handle the ticker being a kwarg
-            else:
-                if "-" in kwargs["quote_ticker"]:
-                    kwargs["quote_ticker"] = kwargs["quote_ticker"].split("-")[0]
-                else:
-                    kwargs["quote_ticker"] = kwargs["quote_ticker"] + "-USD"
-            output = await func(*args, **kwargs)
-            # Update the output with the original list of similar tickers
-            if output.get("error_code") == 404 and similar_tickers != []:
-                output["similar_tickers"] = similar_tickers
+        # The decorated function is either a method of the bot or a function that takes a cog as self
+        resolver = getattr(args[0], "ticker_resolver", None) or args[0].bot.ticker_resolver
+        await resolver.ensure_loaded()
+
+        # Handle the ticker being an arg or a kwarg
+        ticker_is_kwarg = kwargs.get("quote_ticker") is not None
+        ticker = kwargs["quote_ticker"] if ticker_is_kwarg else args[1]
+
+        def call(t: str):
+            if ticker_is_kwarg:
+                return func(*args, **dict(kwargs, quote_ticker=t))
+            return func(args[0], t, *args[2:], **kwargs)
+
+        # Return the stored error if the ticker is already known to be invalid
+        invalid_key = (func.__name__, ticker.upper())
+        output = resolver.get_invalid(invalid_key)
+        if output is not None:
+            return output
+
+        # Try the form of the ticker that worked last time first
+        first, second = resolver.candidates(ticker)
+        output = await call(first)
+        if output.get("error") is None:
+            resolver.learn(ticker, first)
+            return output
+        first_error_code = output.get("error_code")
+        # Store the original list of similar tickers if the error is a 404 error
+        similar_tickers = output.get("similar_tickers") if first_error_code == 404 else None
+
+        output = await call(second)
+        if output.get("error") is None:
+            resolver.learn(ticker, second)
+            return output
+        # Update the output with the original list of similar tickers
+        if output.get("error_code") == 404 and similar_tickers:
+            output["similar_tickers"] = similar_tickers
+        # Only remember the ticker as invalid if both forms were confirmed to not exist
+        if first_error_code == 404 and output.get("error_code") == 404:
+            resolver.mark_invalid(invalid_key, output)
         return output
     return wrapper
 
 
+class TickerResolver:
+    """Remembers the canonical form of tickers (e.g. DOGE -> DOGE-USD, AAPL -> AAPL) and which
+    tickers are invalid. The canonical forms are stored in the database so that they persist
+    between restarts.
+    """
+
+    def __init__(self, collection: motor.motor_asyncio.AsyncIOMotorCollection = None, max_invalid: int = 1024, invalid_ttl: float = 60 * 60):
+        """
+        Args:
+            collection (AsyncIOMotorCollection, optional): The collection to store canonical forms in.
+            max_invalid (int, optional): The maximum number of invalid tickers to remember.
+            invalid_ttl (float, optional): How many seconds a ticker is remembered as invalid for.
+        """
+        self.collection = collection
+        self.max_invalid = max_invalid
+        self.invalid_ttl = invalid_ttl
+        self.canonical = {} # ticker -> canonical ticker
+        self._invalid = OrderedDict() # (function name, ticker) -> (error output, timestamp)
+        self._loaded = False
+        self._load_lock = None
+
+    async def ensure_loaded(self):
+        """Loads the canonical forms from the database the first time it is called."""
+        if self._loaded or self.collection is None:
+            return
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        async with self._load_lock:
+            if self._loaded:
+                return
+            async for doc in self.collection.find({}):
+                self.canonical[doc["_id"]] = doc["canonical"]
+            self._loaded = True
+
+    def candidates(self, ticker: str):
+        """Returns both forms of a ticker, ordered so that its known canonical form is first.
+
+        Args:
+            ticker (str): The ticker provided by the user.
+
+        Returns:
+            tuple: The form of the ticker to try first and the form to try second.
+        """
+        ticker = ticker.upper()
+        if "-" in ticker:
+            alternate = ticker.split("-")[0]
+        else:
+            alternate = ticker + "-USD"
+        if self.canonical.get(ticker) == alternate:
+            return alternate, ticker
+        return ticker, alternate
+
+    def learn(self, ticker: str, canonical: str):
+        """Remembers that ticker resolves to canonical and saves it to the database if it is new."""
+        ticker, canonical = ticker.upper(), canonical.upper()
+        if self.canonical.get(ticker) == canonical:
+            return
+        self.canonical[ticker] = canonical
+        if self.collection is not None:
+            asyncio.ensure_future(self._save(ticker, canonical))
+
+    async def _save(self, ticker: str, canonical: str):
+        try:
+            await self.collection.update_one({"_id": ticker}, {"$set": {"canonical": canonical}}, upsert=True)
+        except Exception as e:
+            print(f"Failed to save the canonical form of {ticker}\n{e.__class__.__name__}: {e}")
+
+    def get_invalid(self, key):
+        """Returns a copy of the stored error output if the ticker is known to be invalid, otherwise None."""
+        entry = self._invalid.get(key)
+        if entry is None:
+            return None
+        output, timestamp = entry
+        if time.time() - timestamp > self.invalid_ttl:
+            del self._invalid[key]
+            return None
+        return dict(output)
+
+    def mark_invalid(self, key, output: dict):
+        """Remembers that the ticker is invalid along with the error output (including similar_tickers)."""
+        self._invalid[key] = (dict(output), time.time())
+        self._invalid.move_to_end(key)
+        while len(self._invalid) > self.max_invalid:
+            self._invalid.popitem(last=False)
+
+
+class UserResolver:
+    """Resolves user ids to users while avoiding REST calls. The bot's gateway cache is checked
+    first, then a bounded LRU cache of users that were recently fetched, and only then is the user
+    fetched from the API.
+    """
+
+    def __init__(self, bot: commands.Bot, max_users: int = 1024, ttl: float = 60 * 60):
+        """
+        Args:
+            bot (commands.Bot): The bot whose gateway cache and API are used.
+            max_users (int, optional): The maximum number of fetched users to remember.
+            ttl (float, optional): How many seconds a fetched user is remembered for.
+        """
+        self.bot = bot
+        self.max_users = max_users
+        self.ttl = ttl
+        self._users = OrderedDict() # user_id -> (user, timestamp)
+        self.hits = {"gateway": 0, "lru": 0}
+        self.misses = 0
+
+    async def get(self, user_id: int):
+        """Returns the user with an id.
+
+        Raises:
+            discord.errors.NotFound: If the user doesn't exist.
+        """
+        user_id = int(user_id)
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            self.hits["gateway"] += 1
+            return user
+
+        entry = self._users.get(user_id)
+        if entry is not None:
+            user, timestamp = entry
+            if time.time() - timestamp <= self.ttl:
+                self._users.move_to_end(user_id)
+                self.hits["lru"] += 1
+                return user
+            del self._users[user_id]
+
+        self.misses += 1
+        user = await self.bot.fetch_user(user_id)
+        self._users[user_id] = (user, time.time())
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return user
+
+
+def cached_quote(func):
+    """A decorator that serves the output of a quote fetching method from the bot's quote cache.
+    The decorated method accepts an optional max_age kwarg (in seconds) which lets the caller
+    decide how fresh the data must be. Passing max_age=0 forces a refresh. Methods that declare a
+    max_age parameter themselves receive it too, so that they can pass it on to the cached methods
+    they call.
+    """
+    passes_max_age = "max_age" in inspect.signature(func).parameters
+
+    @functools.wraps(func)
+    async def wrapper(self, ticker: str, max_age: float = None):
+        key = (func.__name__, ticker.upper())
+        kwargs = {"max_age": max_age} if passes_max_age else {}
+        return await self.quote_cache.get(key, lambda: func(self, ticker, **kwargs), max_age=max_age)
+    return wrapper
+
+
+class QuoteCache:
+    """An in-memory TTL cache for quote data. Concurrent requests for the same key share a single
+    in-flight fetch, and entries that are slightly past their TTL are served while they are
+    refreshed in the background (stale-while-revalidate).
+    """
+
+    def __init__(self, ttls: dict = None, default_ttl: float = 60, stale_ttl: float = 120, max_entries: int = 2048):
+        """
+        Args:
+            ttls (dict, optional): The number of seconds an entry stays fresh for each asset type.
+            default_ttl (float, optional): The TTL used for asset types not found in ttls.
+            stale_ttl (float, optional): How long past its TTL an entry may still be served while it is refreshed.
+            max_entries (int, optional): The maximum number of entries before the oldest are evicted.
+        """
+        self.ttls = ttls or {
+            "crypto": 30,
+            "stock": 60,
+            "etf": 60
+        }
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (data, fetched_at)
+        self._in_flight = {} # key -> asyncio.Task
+
+    def ttl(self, data: dict):
+        """Returns the number of seconds the data stays fresh for based on its asset type."""
+        return self.ttls.get(data.get("_type"), self.default_ttl)
+
+    def expires_at(self, data: dict, fetched_at: float):
+        """Returns the unix timestamp the data stops being fresh at. Stock and ETF quotes fetched
+        after the market closed stay fresh until the next open since their prices can't change.
+        """
+        if data.get("_type") != "crypto":
+            expiry = market.closed_quote_expiry(fetched_at, time.time())
+            if expiry is not None:
+                return expiry
+        return fetched_at + self.ttl(data)
+
+    async def get(self, key, fetch, max_age: float = None):
+        """Returns the cached data for key, calling fetch to retrieve it if it is missing or too old.
+
+        Args:
+            key (Hashable): The key the data is stored under.
+            fetch (Callable): A function returning a coroutine that fetches the data.
+            max_age (float, optional): The maximum age of the data in seconds. Stale data is
+                never served when this is provided.
+
+        Returns:
+            dict: A copy of the data with the as_of and cache_age keys added.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            data, fetched_at = entry
+            now = time.time()
+            expires_at = self.expires_at(data, fetched_at) if max_age is None else fetched_at + max_age
+            if now <= expires_at:
+                return self._stamp(data, fetched_at)
+            if max_age is None and now <= expires_at + self.stale_ttl:
+                self._refresh(key, fetch) # Refresh the entry in the background
+                return self._stamp(data, fetched_at)
+        data, fetched_at = await asyncio.shield(self._refresh(key, fetch))
+        # The fetch in flight may have been started without max_age, in which case it could have
+        # been served from older cached data. Fetch again with this caller's max_age if so.
+        if max_age is not None and data.get("error") is None and time.time() - fetched_at > max_age:
+            data, fetched_at = await self._fetch(key, fetch)
+        return self._stamp(data, fetched_at)
+
+    def lookup(self, key, max_age: float = None):
+        """Returns the cached data for key without fetching it.
+
+        Args:
+            key (Hashable): The key the data is stored under.
+            max_age (float, optional): The maximum age of the data in seconds. Defaults to the TTL,
+                or until the next open for stock quotes fetched after the market closed.
+
+        Returns:
+            dict or None: A copy of the data or None if it is missing or too old.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        data, fetched_at = entry
+        expires_at = self.expires_at(data, fetched_at) if max_age is None else fetched_at + max_age
+        if time.time() > expires_at:
+            return None
+        return self._stamp(data, fetched_at)
+
+    def store(self, key, data: dict, fetched_at: float = None):
+        """Stores data that was fetched outside of get() in the cache and returns a stamped copy of it."""
+        if fetched_at is None:
+            fetched_at = time.time()
+        self._entries[key] = (data, fetched_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return self._stamp(data, fetched_at)
+
+    def invalidate(self, key):
+        """Removes an entry from the cache."""
+        self._entries.pop(key, None)
+
+    def _refresh(self, key, fetch):
+        """Starts fetching the data for key unless a fetch is already in flight and returns the task."""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._on_refresh_done(key, t))
+        return task
+
+    def _on_refresh_done(self, key, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        # Retrieve the exception so that failed background refreshes are not reported as unhandled
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Failed to refresh {key}\n{task.exception().__class__.__name__}: {task.exception()}")
+
+    async def _fetch(self, key, fetch):
+        data = await fetch()
+        # Data that came from another cached method is only as fresh as that method's entry
+        fetched_at = time.time()
+        if data.get("as_of") is not None:
+            fetched_at = min(fetched_at, data["as_of"])
+        # Only successful responses are cached
+        if data.get("error") is None:
+            self.store(key, data, fetched_at)
+        return data, fetched_at
+
+    def _stamp(self, data, fetched_at: float):
+        """Returns a copy of the data containing when it was fetched and how old it is. A copy is
+        returned so that callers can safely modify the output without changing the cached data.
+        """
+        cache_age = round(time.time() - fetched_at, 3)
+        if isinstance(data, Quote):
+            return data.replace(as_of=fetched_at, cache_age=cache_age)
+        return dict(data, as_of=fetched_at, cache_age=cache_age)
+
+
 class ProfitGreenBot(commands.Bot):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, worker: bool = False, **kwargs):
+        """
+        Args:
+            worker (bool, optional): Whether the bot is a task worker started by worker.py, which
+                runs the background tasks of its partitions without connecting to the gateway.
+        """
         super().__init__(*args, **kwargs)
+        self.worker = worker
 
         # Connect to the database
         self.db_client = motor.motor_asyncio.AsyncIOMotorClient(Config.DB_CONNECTION_STRING)
         self.db: motor.motor_asyncio.AsyncIOMotorDatabase = self.db_client["ProfitGreen"]
         self.portfolio: motor.motor_asyncio.AsyncIOMotorCollection = self.db["Portfolio"]
         self.tasks: motor.motor_asyncio.AsyncIOMotorCollection = self.db["Tasks"]
+        self.tickers: motor.motor_asyncio.AsyncIOMotorCollection = self.db["Tickers"]
+        self.trade_history: motor.motor_asyncio.AsyncIOMotorCollection = self.db["TradeHistory"]
+        self.do_not_dm: motor.motor_asyncio.AsyncIOMotorCollection = self.db["DoNotDM"]
+        self.jobs: motor.motor_asyncio.AsyncIOMotorCollection = self.db["Jobs"]
+
+        # Buffer trades and write them to the TradeHistory collection in batches
+        self.trade_log = TradeLog(self.trade_history, self.portfolio)
+        # Send DMs from a queue so that the loops never wait on Discord
+        self.notifier = Notifier(self, self.do_not_dm)
+        # Run jobs such as upvote reminders at a set time
+        self.delayed_jobs = DelayedJobs(self.jobs)
+
+        # Remember the canonical form of tickers and which tickers are invalid
+        self.ticker_resolver = TickerResolver(self.tickers)
+
+        # Cache quote data so that the same ticker isn't fetched repeatedly
+        self.quote_cache = QuoteCache()
+        # Resolve users from the gateway cache or recently fetched users before using the API
+        self.user_resolver = UserResolver(self)
+
+        # HTTP session settings for each class of upstream host. Sessions are created lazily
+        # by get_session because they must be created inside the running event loop. Every
+        # request made by http_request waits for a token from the host's rate limiter, where
+        # rate is the number of requests per second and burst is how many can be made at once.
+        self.session_settings = {
+            "profitgreen_api": {"limit_per_host": 20, "timeout": 15, "ssl": False, "rate": 5, "burst": 10},
+            "cnbc": {"limit_per_host": 20, "timeout": 10, "rate": 5, "burst": 10, "headers": {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.113 Safari/537.36"}},
+            "topgg": {"limit_per_host": 4, "timeout": 10, "rate": 1, "burst": 2},
+            "alphavantage": {"limit_per_host": 4, "timeout": 15, "rate": 5 / 60, "burst": 5}, # 5 requests per minute on the free plan
+            "web": {"limit_per_host": 6, "timeout": 15, "rate": 2, "burst": 4} # Scraped pages (Yahoo Finance, ig.com)
+        }
+        self.rate_limiters = {
+            name: TokenBucket(name, settings["rate"], settings["burst"]) for name, settings in self.session_settings.items()
+        }
+        self._sessions = {}
+        # Record or replay upstream responses when benchmarking offline
+        self.fixtures = FixtureArchive(Config.FIXTURE_MODE, Config.FIXTURE_PATH, Config.FIXTURE_LATENCY, Config.FIXTURE_ERROR_RATE)
+        self.cnbc_batch_size = 25 # The number of symbols sent to CNBC Finance in one request
+        # Track the latency and failures of each quote provider
+        self.provider_health = {
+            "cnbc": ProviderHealth("CNBC Finance"),
+            "profitgreen_api": ProviderHealth("ProfitGreenAPI", default_p95=3)
+        }
+
+        # Keep the prices of alert, order and portfolio tickers in memory
+        self.price_hub = PriceHub(self)
+        # Index the price alerts by ticker and target price
+        self.alert_index = AlertIndex()
+        # Keep the resting limit orders in per-ticker heaps
+        self.order_book = OrderBook()
+        # Keep the Tasks collection in memory and feed its price alerts and limit orders to the indexes
+        self.tasks_watcher = TasksWatcher(self.tasks)
+        self.tasks_watcher.register("price_alert", self.alert_index.add, self.alert_index.remove)
+        self.tasks_watcher.register("LIMIT_ORDER", self.order_book.add, self.order_book.remove)
+        # Split the tasks between the task workers by a hash of their ticker or user
+        self.partitions = None
+        if worker:
+            self.partitions = PartitionLeases(self.db["Leases"], self.db["Workers"], Config.WORKER_ID, Config.WORKER_PARTITIONS, Config.WORKER_LEASE_TTL, Config.WORKER_LEASE_TTL / 3)
 
         # Bot settings
         self._emojis = {
@@ -74,6 +461,131 @@ class ProfitGreenBot(commands.Bot):
         for stock in rewards:
             self.reward_stocks[stock] = random.randint(15, 25)
     
+    def get_session(self, name: str):
+        """Returns the long-lived HTTP session for a class of upstream hosts, creating it if needed.
+        Reusing the session keeps connections alive so that each request doesn't have to perform
+        a new TCP and TLS handshake.
+
+        Args:
+            name (str): The name of the host class in session_settings.
+
+        Returns:
+            aiohttp.ClientSession: The pooled session for the host class.
+        """
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            settings = self.session_settings[name]
+            connector = aiohttp.TCPConnector(
+                limit=settings["limit_per_host"] * 2,
+                limit_per_host=settings["limit_per_host"],
+                ttl_dns_cache=300, # Cache DNS lookups for 5 minutes
+                keepalive_timeout=60,
+                ssl=settings.get("ssl")
+            )
+            timeout = aiohttp.ClientTimeout(total=settings["timeout"], connect=5)
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=settings.get("headers"), trace_configs=[self._rate_limit_trace(name)])
+            self._sessions[name] = session
+        return session
+
+    def _rate_limit_trace(self, name: str):
+        """Creates the trace config that adjusts the rate of the host's rate limiter whenever the
+        host responds with 429 Too Many Requests.
+        """
+        limiter = self.rate_limiters[name]
+
+        async def on_request_end(session, trace_config_ctx, params):
+            if params.response.status == 429:
+                try:
+                    retry_after = float(params.response.headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    retry_after = None
+                limiter.throttle(retry_after)
+            else:
+                limiter.recover()
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    async def http_request(self, name: str, method: str, url: str, response_type: str = "json", **kwargs):
+        """Makes a request through the pooled session of a host class and returns the body of the
+        response. Responses are recorded to or replayed from the fixture archive if it is enabled.
+
+        Args:
+            name (str): The name of the host class in session_settings.
+            method (str): The HTTP method of the request.
+            url (str): The url of the request.
+            response_type (str, optional): "json" to parse the body as JSON or "text" to return it as is.
+            **kwargs: Passed to aiohttp.ClientSession.request (e.g. params, headers, data).
+
+        Returns:
+            dict, list or str: The body of the response.
+        """
+        async def fetch():
+            session = self.get_session(name)
+            # Wait for a token before the request starts, so the wait doesn't count towards the
+            # session's timeout
+            await self.rate_limiters[name].acquire()
+            async with session.request(method, url, **kwargs) as resp:
+                if response_type == "json":
+                    return await resp.json(content_type=None)
+                return await resp.text()
+        return await self.fixtures.call(self.fixtures.key(name, method, url, kwargs.get("params")), fetch)
+
+    async def close(self):
+        """Writes the buffered trades, closes all HTTP sessions and saves any recorded fixtures
+        before shutting down the bot.
+        """
+        self.tasks_watcher.stop()
+        self.delayed_jobs.stop()
+        if self.partitions is not None:
+            await self.partitions.stop()
+        self.notifier.stop()
+        await self.trade_log.stop()
+        self.fixtures.save()
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+        await super().close()
+
+    async def login(self, token: str):
+        """Creates any missing database indexes, then logs in."""
+        await ensure_indexes(self.db)
+        await super().login(token)
+
+    @property
+    def runs_tasks(self):
+        """Whether this process runs the background tasks. The bot leaves them to the task workers
+        if TASK_WORKERS is set.
+        """
+        return self.worker or (Config.PRODUCTION and not Config.TASK_WORKERS)
+
+    def owns_task(self, key):
+        """Returns whether a task with a ticker or user id is handled by this process. Without
+        task workers, the bot handles every task.
+        """
+        return self.partitions is None or self.partitions.owns(key)
+
+    async def wait_until_ready(self):
+        """Waits until the bot is ready. Task workers never connect to the gateway, so they are
+        ready as soon as they have logged in.
+        """
+        if self.worker:
+            return
+        await super().wait_until_ready()
+
+    def is_crypto(self, ticker: str):
+        """Returns whether a ticker is a crypto, using its canonical form if it is known.
+
+        Args:
+            ticker (str): The ticker of the stock or crypto.
+
+        Returns:
+            bool: True if the ticker is a crypto.
+        """
+        ticker = ticker.upper()
+        return self.ticker_resolver.canonical.get(ticker, ticker).endswith("-USD")
+
     def commify(self, n):
         """Adds commas to a number and returns it as a string.
 
@@ -85,48 +597,148 @@ class ProfitGreenBot(commands.Bot):
         """
         return '{:,}'.format(n)
     
+    async def resolve_user(self, user_id: int):
+        """Returns the user with an id, only making a request if they aren't cached."""
+        return await self.user_resolver.get(user_id)
+
     async def create_portfolio(self, user: discord.User):
-        if await self.fetch_portfolio(user.id) is None:
-            user = await self.fetch_user(user.id)
+        # Only check whether the portfolio exists instead of reading all of it
+        if await self.portfolio.find_one({"_id": user.id}, {"_id": 1}) is None:
+            user = await self.resolve_user(user.id)
             await self.portfolio.insert_one(
                 {
                     "_id": user.id,
                     "username": f"{user.name}#{user.discriminator}",
                     "balance": self.portfolio_starting_value,
-                    "portfolio": [],
-                    "trade_history": []
+                    "portfolio": []
                 },
             )
     
+    @query_shape("Portfolio", {"_id": 0})
     async def fetch_portfolio(self, user_id: int):
-        # Get the user's portfolio
-        cursor = self.portfolio.find({"_id": user_id})
+        # Get the user's portfolio, leaving out the trade history of portfolios that haven't been migrated yet
+        cursor = self.portfolio.find({"_id": user_id}, {"trade_history": 0})
         for doc in await cursor.to_list(100):
             if doc.get("_id") == user_id:
                 return doc
         return None
     
-    async def log_trade(self, user_id: int, _type: str, ticker: str, quantity: int, price: float, vote_reward=False):
-        # Fetch the user's portfolio
-        portfolio_data = await self.fetch_portfolio(user_id)
-        # Update the trade_history field of the user's portfolio
-        portfolio_data["trade_history"].append(
-            {
-                "_type": _type,
-                "datetime": str(datetime.datetime.utcnow().replace(microsecond=0)), # Round down to the nearest second
-                "timestamp": round(time.time()), # Round down to the nearest second
-                "ticker": ticker,
-                "quantity": quantity,
-                "price": price,
-                "vote_reward": vote_reward
-            }
-        )
-        # Upload the changes to the database
-        await self.portfolio.update_one(
-            {"_id": user_id},
-            {"$set": portfolio_data}
+    def trade_record(self, _type: str, ticker: str, quantity: int, price: float, vote_reward=False):
+        """Creates an entry for the trade history of a user."""
+        return {
+            "_type": _type,
+            "datetime": str(datetime.datetime.utcnow().replace(microsecond=0)), # Round down to the nearest second
+            "timestamp": round(time.time()), # Round down to the nearest second
+            "ticker": ticker,
+            "quantity": quantity,
+            "price": price,
+            "vote_reward": vote_reward
+        }
+
+    def log_trade(self, user_id: int, _type: str, ticker: str, quantity: int, price: float, vote_reward=False):
+        # Buffer the trade to be written to the TradeHistory collection in the next batch
+        self.trade_log.record(user_id, self.trade_record(_type, ticker, quantity, price, vote_reward))
+
+    async def fetch_holdings(self, user_id: int):
+        """Fetches the balance and holdings of a portfolio."""
+        return await self.portfolio.find_one({"_id": user_id}, {"balance": 1, "portfolio": 1})
+
+    async def buy_shares(self, user_id: int, ticker: str, quantity: int, price: float, cost: float = None, portfolio_data: dict = None, vote_reward=False, max_attempts: int = 5):
+        """Atomically deducts the cost of a trade from a user's balance and adds the shares to their
+        holding in a single conditional update, then logs the trade. The update only applies if the
+        user has enough cash and their holding hasn't changed since it was read, otherwise the
+        holding is read again and the update retried, so concurrent trades never overwrite each other.
+
+        Args:
+            user_id (int): The id of the user.
+            ticker (str): The ticker of the stock or crypto.
+            quantity (int): The number of shares bought.
+            price (float): The price of each share.
+            cost (float, optional): The amount deducted from the balance. Defaults to quantity * price.
+            portfolio_data (dict, optional): A recently read portfolio used for the first attempt.
+            vote_reward (bool, optional): Whether the shares are a vote reward.
+            max_attempts (int, optional): The number of times to retry if the holding changes.
+
+        Returns:
+            float or None: The user's new balance or None if they don't have enough cash.
+        """
+        if cost is None:
+            cost = round(quantity * price, 5)
+        for _ in range(max_attempts):
+            if portfolio_data is None:
+                portfolio_data = await self.fetch_holdings(user_id)
+            if portfolio_data is None or portfolio_data["balance"] < cost:
+                return None
+            holding = next((q for q in portfolio_data["portfolio"] if q["ticker"] == ticker), None)
+
+            query = {"_id": user_id, "balance": {"$gte": cost}}
+            update = {"$inc": {"balance": -cost}}
+            if holding is None:
+                # Add a new holding as long as the user still doesn't hold the ticker
+                query["portfolio.ticker"] = {"$ne": ticker}
+                update["$push"] = {
+                    "portfolio": {
+                        "ticker": ticker,
+                        "quantity": quantity,
+                        "buy_price": price
+                    }
+                }
+            else:
+                # Update the quantity and the average buy price of the holding as long as it hasn't changed
+                query["portfolio"] = {"$elemMatch": {"ticker": ticker, "quantity": holding["quantity"], "buy_price": holding["buy_price"]}}
+                update["$inc"]["portfolio.$.quantity"] = quantity
+                update["$set"] = {
+                    "portfolio.$.buy_price": round((holding["buy_price"] * holding["quantity"] + price * quantity) / (holding["quantity"] + quantity), 3)
+                }
+
+            result = await self.portfolio.find_one_and_update(query, update, projection={"balance": 1}, return_document=ReturnDocument.AFTER)
+            if result is not None:
+                self.log_trade(user_id, "BUY", ticker, quantity, price, vote_reward)
+                return round(result["balance"], 3)
+            portfolio_data = None # The portfolio changed since it was read, so read it again
+        print(f"Gave up buying {quantity} shares of {ticker} for {user_id} after {max_attempts} conflicting updates")
+        return None
+
+    async def sell_shares(self, user_id: int, ticker: str, quantity: int, price: float):
+        """Atomically removes shares from a user's holding and adds the proceeds to their balance in
+        a single conditional update that only applies if the user has enough shares, then logs the
+        trade. The holding is removed in the same update if all of its shares were sold, so an
+        empty holding is never left behind.
+
+        Args:
+            user_id (int): The id of the user.
+            ticker (str): The ticker of the stock or crypto.
+            quantity (int): The number of shares sold.
+            price (float): The price of each share.
+
+        Returns:
+            float or None: The user's new balance or None if they don't have enough shares.
+        """
+        total = round(quantity * price, 5)
+        # Use an update pipeline to subtract the shares and drop the holdings left with no shares
+        sold = {"$map": {
+            "input": "$portfolio",
+            "in": {"$cond": [
+                {"$eq": ["$$this.ticker", ticker]},
+                {"$mergeObjects": ["$$this", {"quantity": {"$subtract": ["$$this.quantity", quantity]}}]},
+                "$$this"
+            ]}
+        }}
+        result = await self.portfolio.find_one_and_update(
+            {"_id": user_id, "portfolio": {"$elemMatch": {"ticker": ticker, "quantity": {"$gte": quantity}}}},
+            [{"$set": {
+                "balance": {"$add": ["$balance", total]},
+                "portfolio": {"$filter": {"input": sold, "cond": {"$gt": ["$$this.quantity", 0]}}}
+            }}],
+            projection={"balance": 1},
+            return_document=ReturnDocument.AFTER
         )
+        if result is None:
+            return None
+        self.log_trade(user_id, "SELL", ticker, quantity, price)
+        return round(result["balance"], 3)
     
+    @cached_quote
     @insensitive_ticker
     async def cnbc_data(self, ticker: str):
         """Fetches the price of a stock or cryptocurrency from CNBC Finance's API. This should
@@ -134,74 +746,163 @@ class ProfitGreenBot(commands.Bot):
 
         Args:
             ticker (str): The ticker of the stock or cryptocurrency to fetch the price of.
+            max_age (float, optional): The maximum age in seconds of cached data that may be returned.
 
         Returns:
-            dict: A dict containing the price or an error code.
-        """
-        # The function that will perform the synchronous request to the API
-        def sync_request(ticker: str):
-            quote_object = cnbcfinance.Cnbc(ticker)
-            result = quote_object.get_quote()
-            if result.get("last") is None:
-                result = {
-                    "error": "Could not find the ticker.",
-                    "error_code": 404
-                }
-            else:
-                result = {
-                    "_type": result["assetType"].lower(),
-                    "change": result["change"],
-                    "change_pct": result["change_pct"],
-                    "name": result["name"],
-                    "open": float(result["open"]),
-                    "price": float(result.get("last")),
-                    "ticker": ticker
-                }
+            Quote or dict: The quote or a dict containing an error code.
+        """
+        # Request the quote through the pooled CNBC session instead of blocking a thread in the
+        # executor. Only the upstream request is timed, so cache hits don't count as latencies.
+        result = await timed_request(self.provider_health["cnbc"], self._cnbc_batch([ticker]))
+        if result.get("error") is not None:
             return result
-        # We need to run the event loop in the executor in order to make this a non-blocking sync function
-        # This way, other commands can still run while the data is being fetched, however the original
-        # command will wait for this to finish
-        loop = asyncio.get_event_loop()
-        output = await loop.run_in_executor(None, sync_request, ticker)
+        output = result["quotes"].get(ticker.upper())
+        if output is None:
+            # A response that leaves the ticker out doesn't confirm that it doesn't exist
+            output = {
+                "error": "CNBC Finance didn't return the ticker.",
+                "error_code": 502
+            }
         return output
     
+    async def cnbc_quotes(self, tickers: list):
+        """Fetches the prices of multiple stocks or cryptocurrencies from CNBC Finance's API in a
+        single request.
+
+        Args:
+            tickers (list): The tickers to fetch the prices of.
+
+        Returns:
+            dict: A dict mapping each ticker in the response to its Quote, or to a dict containing
+                a 404 error if CNBC Finance returned it without a price. Tickers that aren't in the
+                response are left out.
+        """
+        url = "https://quote.cnbc.com/quote-html-webservice/quote.htm"
+        params = {
+            "symbols": "|".join(tickers),
+            "requestMethod": "quick",
+            "exthrs": "1",
+            "noform": "1",
+            "fund": "1",
+            "output": "json",
+            "events": "1"
+        }
+        data = await self.http_request("cnbc", "GET", url, params=params)
+
+        # CNBC returns a dict when one symbol is requested and a list when multiple are requested
+        quotes = (data.get("QuickQuoteResult") or {}).get("QuickQuote") or []
+        if isinstance(quotes, dict):
+            quotes = [quotes]
+        output = {}
+        for quote in quotes:
+            result = self.parse_cnbc_quote(quote)
+            if result.get("error") is None:
+                output[result.ticker] = result
+            elif isinstance(quote.get("symbol"), str):
+                output.setdefault(quote["symbol"].upper(), result) # The ticker was confirmed to not exist
+        return output
+
+    def _cnbc_batch(self, tickers: list):
+        """Returns a function that fetches a batch of quotes in the format expected by timed_request."""
+        async def fetch():
+            return {"quotes": await self.cnbc_quotes(tickers)}
+        return fetch
+
+    def parse_cnbc_quote(self, quote: dict):
+        """Parses a quote returned by CNBC Finance's API.
+
+        Args:
+            quote (dict): A single quote from the API's response.
+
+        Returns:
+            Quote or dict: The parsed quote or a dict containing an error code.
+        """
+        try:
+            return Quote.from_cnbc(quote)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return {
+                "error": "Could not find the ticker.",
+                "error_code": 404
+            }
+
+    async def fetch_briefs(self, tickers: list, max_age: float = None):
+        """Fetches brief data about multiple quotes at once. Quotes that aren't cached are
+        requested from CNBC Finance in batches and all share the same as_of timestamp. Cryptos
+        and tickers that CNBC Finance can't find are fetched individually with fetch_brief.
+
+        Args:
+            tickers (list): The tickers of the stocks or cryptos. Duplicates are only fetched once.
+            max_age (float, optional): The maximum age in seconds of cached data that may be returned.
+
+        Returns:
+            dict: A dict mapping each uppercased ticker to its Quote or a dict containing an error.
+        """
+        tickers = list(dict.fromkeys(t.upper() for t in tickers)) # Remove duplicates while keeping the order
+
+        # Use the cached data for any tickers that have been fetched recently
+        output = {}
+        missing = []
+        for ticker in tickers:
+            data = self.quote_cache.lookup(("fetch_brief", ticker), max_age=max_age)
+            if data is not None:
+                output[ticker] = data
+            else:
+                missing.append(ticker)
+
+        # Request the stocks from CNBC Finance in batches unless it is failing. All cryptos are
+        # handled by Yahoo Finance.
+        stocks = [t for t in missing if not t.endswith("-USD")]
+        if not self.provider_health["cnbc"].available():
+            stocks = []
+        batches = [stocks[i:i + self.cnbc_batch_size] for i in range(0, len(stocks), self.cnbc_batch_size)]
+        fetched_at = time.time()
+        results = await asyncio.gather(*[timed_request(self.provider_health["cnbc"], self._cnbc_batch(batch)) for batch in batches])
+        for batch, result in zip(batches, results):
+            if result.get("error") is not None:
+                print(f"Failed to fetch a batch of quotes from CNBC Finance: {result['error']}")
+                continue
+            result = result["quotes"]
+            for ticker in batch:
+                if ticker in result and result[ticker].get("error") is None:
+                    output[ticker] = self.quote_cache.store(("fetch_brief", ticker), result[ticker], fetched_at)
+
+        # Fetch the remaining tickers individually
+        remaining = [t for t in missing if t not in output]
+        for ticker, data in zip(remaining, await asyncio.gather(*[self.fetch_brief(t, max_age=max_age) for t in remaining])):
+            output[ticker] = data
+        return output
+
+    @cached_quote
     @insensitive_ticker
-    async def fetch_brief(self, quote_ticker: str):
-        """Fetches some brief data about a quote from the CNBC Finance API or from Yahoo Finance."""
+    async def fetch_brief(self, quote_ticker: str, max_age: float = None):
+        """Fetches some brief data about a quote from the CNBC Finance API or from Yahoo Finance.
+        Returns a Quote or a dict containing an error code. max_age is passed on to cnbc_data and
+        fetch_quote, and the Quote's as_of is when they fetched it."""
         
         async def make_yf_req(quote_ticker):
-            """Retrieves the quote from Yahoo Finance and reformats the data."""
-            data = await self.fetch_quote(quote_ticker)
+            """Retrieves the quote from Yahoo Finance and parses it."""
+            data = await self.fetch_quote(quote_ticker, max_age=max_age)
             if data.get("error") is None:
-                return {
-                    "_type": data["_type"],
-                    "change": data["change-dollar"],
-                    "change_pct": data["change-percent"],
-                    "name": data["name"][:-len(f" ({quote_ticker}-USD)")], # Remove the ticker from the name
-                    "open": float(data["open"]),
-                    "price": float(data["price"]),
-                    "ticker": data["ticker"]
-                }
+                return Quote.from_summary(data)
             else:
                 return data
 
         # All cryptos are handled by Yahoo Finance
         if quote_ticker.upper().endswith("-USD"):
-            output = await make_yf_req(quote_ticker)
+            providers = [
+                (self.provider_health["profitgreen_api"], lambda: make_yf_req(quote_ticker))
+            ]
+        # Prefer CNBC Finance for everything else. Yahoo Finance is only requested if CNBC Finance
+        # can't find the ticker, fails, or takes longer than usual to respond.
         else:
-            # Try to get the quote from CNBC Finance however sometimes an Exception is raised
-            try:
-                output = await self.cnbc_data(quote_ticker)
-            except:
-                output = {
-                    "error": "Could not find the ticker.",
-                    "error_code": 404
-                }
-            # Use Yahoo Finance if the ticker is not found in CNBC Finance
-            if output.get("error") is not None:
-                output = await make_yf_req(quote_ticker)
+            providers = [
+                (self.provider_health["cnbc"], lambda: self.cnbc_data(quote_ticker, max_age=max_age)),
+                (self.provider_health["profitgreen_api"], lambda: make_yf_req(quote_ticker))
+            ]
+        output = await hedged_request(providers)
         return output
     
+    @cached_quote
     @insensitive_ticker
     async def fetch_quote(self, quote_ticker: str):
         """Fetch a quote from the ProfitGreenAPI. This function accepts both Stock tickers 
@@ -209,18 +910,19 @@ class ProfitGreenBot(commands.Bot):
 
         Args:
             quote_ticker (str): The ticker of the stock or crypto that will be searched.
+            max_age (float, optional): The maximum age in seconds of cached data that may be returned.
 
         Returns:
-            bool or dict: False if the request failed or the data about the quote_ticker
+            bool or dict: False if the request failed or the data about the quote_ticker. The
+                as_of and cache_age keys contain when the data was fetched and how old it is.
         """
         # Generate the correct url
         url = "https://ProfitGreenAPI.alegend.repl.co/summary/<quote>"
         url = url.replace("<quote>", quote_ticker)
 
-        # Make the request to the api
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False)) as session:
-            async with session.get(url) as req:
-                output = await req.json()
+        # Make the request to the api. Only the upstream request is timed, so cache hits don't
+        # count as latencies.
+        output = await timed_request(self.provider_health["profitgreen_api"], lambda: self.http_request("profitgreen_api", "GET", url))
         
         # Return the data about the quote
         return output
@@ -248,11 +950,12 @@ class ProfitGreenBot(commands.Bot):
         elif quote_data["change-dollar"] < 0:
             em.color = discord.Color.red()
         
-        # Reformat all the integer or float values of the data into strings with commas
-        for key in quote_data:
-            if type(quote_data[key]) == int or type(quote_data[key]) == float:
-                quote_data[key] = format(quote_data[key], ",f") # , = format with commas, f = convert scientific notation to decmial
-                quote_data[key] = quote_data[key].rstrip("0").rstrip(".") # Remove the trailing zeros and decimal point
+        # Reformat all the integer or float values of the data into strings with commas. A copy is
+        # made so that the cached data isn't modified.
+        quote_data = {
+            key: format_number(value) if type(value) == int or type(value) == float else value
+            for key, value in quote_data.items()
+        }
 
         if quote_data["_type"] == "crypto":
             em.description = f"""
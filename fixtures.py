@@ -0,0 +1,107 @@
+import aiohttp
+
+import asyncio
+import copy
+import gzip
+import json
+import os
+import random
+from urllib.parse import urlencode
+
+
+class FixtureArchive:
+    """Records responses from upstream providers to a gzipped JSON archive and replays them so
+    that commands and background loops can be benchmarked offline.
+
+    Modes:
+        None: Requests are sent to the upstream providers as usual.
+        "record": Requests are sent to the upstream providers and their responses are saved.
+        "replay": Saved responses are returned instead of making requests, after an artificial
+            latency and with a chance of raising an injected connection error.
+    """
+
+    # Query parameters that contain credentials and are left out of the keys
+    private_params = ("apikey", "token")
+
+    def __init__(self, mode: str = None, path: str = "fixtures.json.gz", latency: float = 0, error_rate: float = 0, save_every: int = 50):
+        """
+        Args:
+            mode (str, optional): None, "record" or "replay".
+            path (str, optional): The path of the archive.
+            latency (float, optional): The average number of seconds each replayed response is delayed by.
+            error_rate (float, optional): The chance from 0 to 1 that a replayed request raises an error.
+            save_every (int, optional): The number of new recordings between saves of the archive.
+        """
+        if mode not in (None, "record", "replay"):
+            raise ValueError(f"Unknown fixture mode {mode}")
+        self.mode = mode
+        self.path = path
+        self.latency = latency
+        self.error_rate = error_rate
+        self.save_every = save_every
+        self.responses = {}
+        self._unsaved = 0
+        if mode is not None and os.path.exists(path):
+            self.load()
+
+    def key(self, name: str, method: str, url: str, params: dict = None):
+        """Generates the key a response is stored under.
+
+        Args:
+            name (str): The host class the request is made to.
+            method (str): The HTTP method of the request.
+            url (str): The url of the request.
+            params (dict, optional): The query parameters of the request.
+
+        Returns:
+            str: The key of the response.
+        """
+        key = f"{name} {method.upper()} {url}"
+        if params:
+            params = {k: v for k, v in sorted(params.items()) if k.lower() not in self.private_params}
+            key += "?" + urlencode(params)
+        return key
+
+    async def call(self, key: str, fetch, encode=None, decode=None):
+        """Runs fetch, recording or replaying its output depending on the mode.
+
+        Args:
+            key (str): The key the output is stored under.
+            fetch (Callable): A function returning a coroutine that makes the request.
+            encode (Callable, optional): Converts the output into something that can be stored as JSON.
+            decode (Callable, optional): Converts the stored value back into the output.
+
+        Returns:
+            Any: The output of fetch or the replayed output.
+        """
+        if self.mode is None:
+            return await fetch()
+
+        if self.mode == "replay":
+            if self.latency:
+                await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+            if random.random() < self.error_rate:
+                raise aiohttp.ClientConnectionError(f"Injected fixture error for {key}")
+            if key not in self.responses:
+                raise aiohttp.ClientConnectionError(f"No recorded fixture for {key}")
+            value = self.responses[key]
+            return decode(value) if decode is not None else copy.deepcopy(value)
+
+        output = await fetch()
+        self.responses[key] = encode(output) if encode is not None else copy.deepcopy(output)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+        return output
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            self.responses = json.load(f)
+
+    def save(self):
+        """Writes the recorded responses to the archive."""
+        if self.mode != "record" or self._unsaved == 0:
+            return
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            json.dump(self.responses, f, separators=(",", ":"))
+        self._unsaved = 0
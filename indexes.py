@@ -0,0 +1,154 @@
+# indexes.py - Declares the indexes needed by every query shape and creates them on startup.
+# Run it against a local mongod to check that every declared query shape is served by an index.
+from pymongo import ASCENDING, IndexModel
+import motor.motor_asyncio
+import pymongo.errors
+
+import asyncio
+import importlib
+from pathlib import Path
+
+from config import Config
+
+
+# The indexes of each collection. Indexes that only apply to one type of task are partial, so
+# they stay small and aren't updated by writes to the other types.
+INDEXES = {
+    "Tasks": [
+        # A user's limit orders, optionally of one type and ticker (Portfolio.buy, Portfolio.sell,
+        # Portfolio.pending_orders and Portfolio.delete_pending_order)
+        IndexModel(
+            [("user_id", ASCENDING), ("limit_order_type", ASCENDING), ("ticker", ASCENDING)],
+            partialFilterExpression={"_type": "LIMIT_ORDER"}
+        ),
+        # A user's price targets, optionally for one ticker (PriceTargets)
+        IndexModel(
+            [("user_id", ASCENDING), ("quote_ticker", ASCENDING)],
+            partialFilterExpression={"_type": "price_alert"}
+        )
+    ],
+    "Portfolio": [
+        # The tickers held by any user (PriceHub.sync_working_set)
+        IndexModel([("portfolio.ticker", ASCENDING)])
+    ],
+    "TradeHistory": [
+        # A user's trades, newest first (TradeLog.fetch_trades), which scans the index backwards
+        IndexModel([("user_id", ASCENDING), ("timestamp", ASCENDING)])
+    ],
+    "Jobs": [
+        # The jobs due within the next window (DelayedJobs.reload)
+        IndexModel([("due_at", ASCENDING)])
+    ],
+    "DoNotDM": [
+        # The users whose DMs were recently found to be closed (Notifier._load_blocked)
+        IndexModel([("timestamp", ASCENDING)])
+    ],
+    "Leases": [
+        # The partitions leased to a worker (PartitionLeases.stop)
+        IndexModel([("owner", ASCENDING)])
+    ],
+    "Workers": [
+        # The workers that sent a heartbeat recently (PartitionLeases._live_workers)
+        IndexModel([("seen_at", ASCENDING)])
+    ]
+}
+
+# A sample of each query shape that should be served by an index: (collection, filter, sort).
+# The shapes are declared next to the queries they mirror with the query_shape decorator.
+QUERY_SHAPES = []
+
+
+def query_shape(collection: str, query: dict, sort: list = None):
+    """A decorator that declares the shape of a query made by the decorated function, so that
+    running this module can check that it is served by an index. It returns the function as is.
+
+    Args:
+        collection (str): The name of the queried collection.
+        query (dict): A sample filter of the query.
+        sort (list, optional): The sort of the query as a list of (key, direction) tuples.
+    """
+    def decorator(func):
+        QUERY_SHAPES.append((collection, query, sort))
+        return func
+    return decorator
+
+
+def load_query_shapes():
+    """Imports every module that declares query shapes, so that their declarations run.
+
+    Returns:
+        list: The declared query shapes.
+    """
+    root = Path(__file__).parent
+    for path in sorted([*root.glob("*.py"), *root.glob("cogs/*.py")]):
+        if path.resolve() != Path(__file__).resolve() and "@query_shape(" in path.read_text():
+            importlib.import_module(".".join(path.relative_to(root).with_suffix("").parts))
+    # The modules register their shapes with the imported indexes module, which isn't this one
+    # when it is run as a script
+    return importlib.import_module("indexes").QUERY_SHAPES
+
+
+async def ensure_indexes(db):
+    """Creates the declared indexes that don't exist yet. Creating an index that already exists
+    with the same options does nothing.
+
+    Args:
+        db (motor.motor_asyncio.AsyncIOMotorDatabase): The database.
+    """
+    for name, indexes in INDEXES.items():
+        try:
+            await db[name].create_indexes(indexes)
+        except pymongo.errors.PyMongoError as e:
+            print(f"Failed to create the indexes of {name}\n{e.__class__.__name__}: {e}")
+
+
+def _stages(plan: dict):
+    """Yields the stage names of a query plan and all of its input stages."""
+    yield plan.get("stage")
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child is not None:
+            yield from _stages(child)
+
+
+async def find_collection_scans(db, shapes: list = None):
+    """Explains every query shape and returns the ones whose winning plan scans a whole collection.
+
+    Args:
+        db (motor.motor_asyncio.AsyncIOMotorDatabase): The database.
+        shapes (list, optional): The query shapes to explain. Defaults to QUERY_SHAPES.
+
+    Returns:
+        list: The (collection, filter, sort) of the query shapes that aren't served by an index.
+    """
+    scans = []
+    for name, query, sort in (QUERY_SHAPES if shapes is None else shapes):
+        cursor = db[name].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        plan = explanation["queryPlanner"]["winningPlan"]
+        # The slot-based execution engine nests the plan one level deeper
+        if "COLLSCAN" in _stages(plan.get("queryPlan", plan)):
+            scans.append((name, query, sort))
+    return scans
+
+
+async def main():
+    """Creates the indexes on a local test database and reports the declared query shapes that
+    still scan a whole collection. Never run this against the production database.
+    """
+    if Config.INDEX_TEST_DB_CONNECTION_STRING == Config.DB_CONNECTION_STRING:
+        print("INDEX_TEST_DB_CONNECTION_STRING must point to a local test database, not DB_CONNECTION_STRING")
+        return 1
+    shapes = load_query_shapes()
+    db = motor.motor_asyncio.AsyncIOMotorClient(Config.INDEX_TEST_DB_CONNECTION_STRING)["ProfitGreenIndexTest"]
+    await ensure_indexes(db)
+    scans = await find_collection_scans(db, shapes)
+    for name, query, sort in scans:
+        print(f"COLLSCAN: {name}.find({query}){f'.sort({sort})' if sort else ''}")
+    print(f"{len(shapes) - len(scans)}/{len(shapes)} query shapes use an index")
+    return 1 if scans else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main()))
@@ -0,0 +1,162 @@
+"""US stock market calendar used to decide when stock quotes can change.
+
+Regular sessions on NYSE and NASDAQ run from 9:30 AM to 4:00 PM Eastern time on weekdays, except
+on exchange holidays. Sessions close early at 1:00 PM on the day before Independence Day, the day
+after Thanksgiving and Christmas Eve. Cryptos trade around the clock so none of this applies to them.
+"""
+import datetime
+import functools
+from zoneinfo import ZoneInfo
+
+
+EASTERN = ZoneInfo("America/New_York")
+OPEN_TIME = datetime.time(9, 30)
+CLOSE_TIME = datetime.time(16, 0)
+EARLY_CLOSE_TIME = datetime.time(13, 0)
+# Quotes can still change shortly after the close while the closing auction is reported
+SETTLE_SECONDS = 5 * 60
+
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int):
+    """Returns the nth (1-based) occurrence of a weekday (0 = Monday) in a month."""
+    first = datetime.date(year, month, 1)
+    return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + (n - 1) * 7)
+
+
+def _last_weekday(year: int, month: int, weekday: int):
+    """Returns the last occurrence of a weekday (0 = Monday) in a month."""
+    if month == 12:
+        last = datetime.date(year, 12, 31)
+    else:
+        last = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year: int):
+    """Returns the date of Easter Sunday using the anonymous Gregorian algorithm."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+def _observed(date: datetime.date):
+    """Moves a holiday that falls on a weekend to the nearest weekday."""
+    if date.weekday() == 5:
+        return date - datetime.timedelta(days=1)
+    if date.weekday() == 6:
+        return date + datetime.timedelta(days=1)
+    return date
+
+
+@functools.lru_cache(maxsize=None)
+def holidays(year: int):
+    """Returns the set of dates the exchanges are closed in a year (excluding weekends)."""
+    days = {
+        _nth_weekday(year, 1, 0, 3), # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3), # Presidents' Day
+        _easter(year) - datetime.timedelta(days=2), # Good Friday
+        _last_weekday(year, 5, 0), # Memorial Day
+        _observed(datetime.date(year, 7, 4)), # Independence Day
+        _nth_weekday(year, 9, 0, 1), # Labor Day
+        _nth_weekday(year, 11, 3, 4), # Thanksgiving
+        _observed(datetime.date(year, 12, 25)) # Christmas
+    }
+    # New Year's Day isn't observed on the previous Friday when it falls on a Saturday
+    new_years = datetime.date(year, 1, 1)
+    if new_years.weekday() != 5:
+        days.add(_observed(new_years))
+    if year >= 2022:
+        days.add(_observed(datetime.date(year, 6, 19))) # Juneteenth
+    return frozenset(days)
+
+
+@functools.lru_cache(maxsize=None)
+def early_closes(year: int):
+    """Returns the set of dates the exchanges close at 1:00 PM in a year."""
+    days = {
+        datetime.date(year, 7, 3),
+        _nth_weekday(year, 11, 3, 4) + datetime.timedelta(days=1), # The day after Thanksgiving
+        datetime.date(year, 12, 24)
+    }
+    return frozenset(d for d in days if is_trading_day(d))
+
+
+def is_trading_day(date: datetime.date):
+    return date.weekday() < 5 and date not in holidays(date.year)
+
+
+def session(date: datetime.date):
+    """Returns the open and close of the regular session on a date.
+
+    Args:
+        date (datetime.date): The date in Eastern time.
+
+    Returns:
+        tuple or None: The aware open and close datetimes or None if the market is closed all day.
+    """
+    if not is_trading_day(date):
+        return None
+    close_time = EARLY_CLOSE_TIME if date in early_closes(date.year) else CLOSE_TIME
+    return (
+        datetime.datetime.combine(date, OPEN_TIME, tzinfo=EASTERN),
+        datetime.datetime.combine(date, close_time, tzinfo=EASTERN)
+    )
+
+
+def _now(timestamp: float = None):
+    if timestamp is None:
+        return datetime.datetime.now(EASTERN)
+    return datetime.datetime.fromtimestamp(timestamp, EASTERN)
+
+
+def is_open(timestamp: float = None):
+    """Returns whether the regular session is open at a unix timestamp (defaults to now)."""
+    now = _now(timestamp)
+    bounds = session(now.date())
+    return bounds is not None and bounds[0] <= now < bounds[1]
+
+
+def last_close(timestamp: float = None):
+    """Returns the unix timestamp of the most recent close at or before a unix timestamp."""
+    now = _now(timestamp)
+    date = now.date()
+    while True:
+        bounds = session(date)
+        if bounds is not None and bounds[1] <= now:
+            return bounds[1].timestamp()
+        date -= datetime.timedelta(days=1)
+
+
+def next_open(timestamp: float = None):
+    """Returns the unix timestamp of the next open after a unix timestamp."""
+    now = _now(timestamp)
+    date = now.date()
+    while True:
+        bounds = session(date)
+        if bounds is not None and bounds[0] > now:
+            return bounds[0].timestamp()
+        date += datetime.timedelta(days=1)
+
+
+def closed_quote_expiry(fetched_at: float, now: float):
+    """Returns when a stock quote stops being fresh if the market is closed and the quote was
+    fetched after the most recent close settled, otherwise None.
+
+    Args:
+        fetched_at (float): The unix timestamp the quote was fetched at.
+        now (float): The current unix timestamp.
+
+    Returns:
+        float or None: The unix timestamp of the next open or None.
+    """
+    if is_open(now) or fetched_at < last_close(now) + SETTLE_SECONDS:
+        return None
+    return next_open(now)
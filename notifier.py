@@ -0,0 +1,172 @@
+import discord
+
+import asyncio
+import random
+import time
+
+from indexes import query_shape
+
+
+class Notifier:
+    """Sends DMs to users from a queue so that the loops that trigger notifications never wait on
+    Discord. Notifications for the same user that are queued close together are coalesced into a
+    single DM with multiple embeds, and a fixed pool of sender workers delivers them. The HTTP
+    client already waits on Discord's route buckets; on top of that, failed sends are retried with
+    exponential backoff, and users with closed DMs are remembered in the database so that they
+    aren't sent any more DMs for a while.
+    """
+
+    max_embeds = 10 # The maximum number of embeds Discord allows in one message
+
+    def __init__(self, bot, collection, workers: int = 4, coalesce_window: float = 1, max_attempts: int = 4, retry_delay: float = 2, block_ttl: float = 7 * 24 * 60 * 60):
+        """
+        Args:
+            bot (ProfitGreenBot): The bot used to fetch users.
+            collection (motor.motor_asyncio.AsyncIOMotorCollection): The collection of users who
+                can't be sent DMs.
+            workers (int, optional): The number of DMs sent at the same time.
+            coalesce_window (float, optional): The number of seconds a notification waits for
+                others to the same user before it is sent.
+            max_attempts (int, optional): The number of times a DM is attempted.
+            retry_delay (float, optional): The number of seconds before the first retry, which is
+                doubled for every retry after it.
+            block_ttl (float, optional): The number of seconds a user with closed DMs isn't sent DMs for.
+        """
+        self.bot = bot
+        self.collection = collection
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.block_ttl = block_ttl
+        self.blocked = {} # user_id -> timestamp their DMs were found to be closed
+        self.sent = 0
+        self.failed = 0
+        self._pending = {} # user_id -> (timestamp of the first notification, list of (embed, callback))
+        self._queue = None
+        self._workers = []
+
+    def _start(self):
+        """Starts the sender workers the first time a notification is queued, inside the event loop."""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.ensure_future(self._worker(i == 0)) for i in range(self.workers)]
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    def notify(self, user_id: int, embed, callback=None):
+        """Queues a DM to a user without waiting for it to be sent.
+
+        Args:
+            user_id (int): The id of the user.
+            embed (discord.Embed or Callable): The embed, or a function that takes the user and
+                returns the embed.
+            callback (Callable, optional): A coroutine function that is called with whether the
+                DM was sent.
+        """
+        self._start()
+        user_id = int(user_id)
+        if user_id in self._pending:
+            self._pending[user_id][1].append((embed, callback))
+        else:
+            self._pending[user_id] = (time.monotonic(), [(embed, callback)])
+            self._queue.put_nowait(user_id)
+
+    def is_blocked(self, user_id: int):
+        """Returns whether a user's DMs were recently found to be closed."""
+        timestamp = self.blocked.get(user_id)
+        return timestamp is not None and time.time() - timestamp < self.block_ttl
+
+    async def _block(self, user_id: int):
+        self.blocked[user_id] = time.time()
+        await self.collection.update_one({"_id": user_id}, {"$set": {"timestamp": self.blocked[user_id]}}, upsert=True)
+
+    async def _unblock(self, user_id: int):
+        if self.blocked.pop(user_id, None) is not None:
+            await self.collection.delete_one({"_id": user_id})
+
+    @query_shape("DoNotDM", {"timestamp": {"$gt": 0}})
+    async def _load_blocked(self):
+        try:
+            async for doc in self.collection.find({"timestamp": {"$gt": time.time() - self.block_ttl}}):
+                self.blocked[doc["_id"]] = doc["timestamp"]
+        except Exception as e:
+            print(f"Failed to load the users with closed DMs\n{e.__class__.__name__}: {e}")
+
+    async def _worker(self, load_blocked: bool):
+        if load_blocked:
+            await self._load_blocked()
+        while True:
+            user_id = await self._queue.get()
+            try:
+                # Wait for more notifications to the same user to arrive before sending
+                queued_at = self._pending[user_id][0]
+                delay = queued_at + self.coalesce_window - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                _, events = self._pending.pop(user_id)
+                await self._deliver(user_id, events)
+            except Exception as e:
+                print(f"Failed to notify {user_id}\n{e.__class__.__name__}: {e}")
+
+    async def _deliver(self, user_id: int, events: list):
+        """Sends the embeds of a user's notifications in as few DMs as possible. The callbacks are
+        always called, with False for every notification that wasn't sent for any reason, so that
+        tasks waiting on a DM are never left out of their index.
+        """
+        sent = [False] * len(events)
+        try:
+            user = None
+            if not self.is_blocked(user_id):
+                try:
+                    user = await self.bot.resolve_user(user_id)
+                except Exception as e:
+                    print(f"Unable to fetch user {user_id} to notify them\n{e.__class__.__name__}: {e}")
+
+            if user is not None:
+                for i in range(0, len(events), self.max_embeds):
+                    chunk = events[i:i + self.max_embeds]
+                    try:
+                        embeds = [embed(user) if callable(embed) else embed for embed, _ in chunk]
+                        chunk_sent = await self._send(user, embeds)
+                    except Exception as e:
+                        chunk_sent = False
+                        print(f"Unable to notify {user_id}\n{e.__class__.__name__}: {e}")
+                    sent[i:i + len(chunk)] = [chunk_sent] * len(chunk)
+        finally:
+            self.sent += sum(sent)
+            self.failed += len(sent) - sum(sent)
+            for (_, callback), was_sent in zip(events, sent):
+                if callback is not None:
+                    try:
+                        await callback(was_sent)
+                    except Exception as e:
+                        print(f"Notification callback {callback.__qualname__} failed\n{e.__class__.__name__}: {e}")
+
+    async def _send(self, user: discord.User, embeds: list):
+        """Sends a DM, retrying server errors and rate limits with exponential backoff.
+
+        Returns:
+            bool: Whether the DM was sent.
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                await user.send(embeds=embeds)
+                await self._unblock(user.id)
+                return True
+            except discord.errors.Forbidden: # User has DMs disabled
+                print(f"Unable to notify {user.name}#{user.discriminator} (403 Forbidden), not sending them DMs for a while.")
+                await self._block(user.id)
+                return False
+            except discord.errors.HTTPException as e:
+                # Other client errors won't succeed if they are retried
+                if e.status < 500 and e.status != 429:
+                    print(f"Unable to notify {user.name}#{user.discriminator}\n{e.__class__.__name__}: {e}")
+                    return False
+            await asyncio.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+        print(f"Gave up notifying {user.name}#{user.discriminator} after {self.max_attempts} attempts")
+        return False
@@ -0,0 +1,153 @@
+import heapq
+import itertools
+
+
+class OrderBook:
+    """An in-memory book of resting limit orders. Each ticker has a max-heap of BUY orders keyed by
+    execute_price and a min-heap of SELL orders, so the orders that can execute at a price are
+    popped without looking at any of the orders that can't.
+
+    Removed orders are deleted lazily: they are dropped from the order map right away and their
+    heap entries are skipped when they reach the top of the heap. A ticker's heaps are compacted
+    once their stale entries outnumber its resting orders, so orders that are removed far from the
+    market or re-added many times don't build up.
+    """
+
+    def __init__(self):
+        self.orders = {} # str(_id) -> (order document, sequence number of its heap entry)
+        self._buys = {} # ticker -> heap of (-execute_price, sequence number, str(_id))
+        self._sells = {} # ticker -> heap of (execute_price, sequence number, str(_id))
+        self._live = {} # ticker -> number of resting orders
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.orders)
+
+    def tickers(self):
+        """Returns the tickers that have at least one resting order."""
+        return set(self._live)
+
+    def _discard(self, entry):
+        """Updates the count of resting orders of a ticker after one of its orders left the book."""
+        ticker = entry[0]["ticker"].upper()
+        self._live[ticker] -= 1
+        if self._live[ticker] == 0:
+            # Drop the heaps since none of their entries are live
+            del self._live[ticker]
+            self._buys.pop(ticker, None)
+            self._sells.pop(ticker, None)
+
+    def _compact(self, ticker: str):
+        """Rebuilds the heaps of a ticker without their stale entries once there are more stale
+        entries than resting orders.
+        """
+        buys = self._buys.get(ticker, [])
+        sells = self._sells.get(ticker, [])
+        if len(buys) + len(sells) <= 2 * self._live.get(ticker, 0):
+            return
+        for heaps in (self._buys, self._sells):
+            heap = heaps.get(ticker)
+            if heap is None:
+                continue
+            heap[:] = [item for item in heap if self.orders.get(item[2], (None, None))[1] == item[1]]
+            heapq.heapify(heap)
+            if not heap:
+                del heaps[ticker]
+
+    def add(self, order: dict):
+        """Adds a limit order document (which must have an _id) to the book, replacing any older
+        version of the same order.
+        """
+        key = str(order["_id"])
+        old = self.orders.pop(key, None)
+        if old is not None:
+            self._discard(old)
+            self._compact(old[0]["ticker"].upper())
+        sequence = next(self._sequence)
+        self.orders[key] = (order, sequence)
+        ticker = order["ticker"].upper()
+        self._live[ticker] = self._live.get(ticker, 0) + 1
+        if order["limit_order_type"] == "BUY":
+            heapq.heappush(self._buys.setdefault(ticker, []), (-order["execute_price"], sequence, key))
+        else:
+            heapq.heappush(self._sells.setdefault(ticker, []), (order["execute_price"], sequence, key))
+        self._compact(ticker)
+
+    def remove(self, _id):
+        """Removes a limit order from the book by its _id. Does nothing if it isn't in the book."""
+        entry = self.orders.pop(str(_id), None)
+        if entry is not None:
+            self._discard(entry)
+            self._compact(entry[0]["ticker"].upper())
+
+    def _peek(self, heap: list):
+        """Returns the top entry of a heap after dropping the entries of removed orders."""
+        while heap:
+            _, sequence, key = heap[0]
+            entry = self.orders.get(key)
+            if entry is not None and entry[1] == sequence:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def distances(self, ticker: str, price: float):
+        """Returns the relative distances from a price to the best BUY and SELL orders of a ticker.
+        The distance of a side is 0 if its best order is already marketable.
+        """
+        # A price of 0 has no relative distance to anything
+        if price <= 0:
+            return []
+        ticker = ticker.upper()
+        output = []
+        top = self._peek(self._buys.get(ticker, []))
+        if top is not None:
+            output.append(max(0, (price + top[0]) / price)) # The key of a BUY order is -execute_price
+        top = self._peek(self._sells.get(ticker, []))
+        if top is not None:
+            output.append(max(0, (top[0] - price) / price))
+        return output
+
+    def _pop_while(self, heap: list, marketable):
+        output = []
+        while heap and marketable(heap[0][0]):
+            _, sequence, key = heapq.heappop(heap)
+            entry = self.orders.get(key)
+            # Skip entries of orders that were removed or replaced
+            if entry is None or entry[1] != sequence:
+                continue
+            del self.orders[key]
+            output.append(entry[0])
+            self._live[entry[0]["ticker"].upper()] -= 1
+        return output
+
+    def pop_marketable(self, ticker: str, price: float):
+        """Removes and returns the orders for a ticker that can execute at a price. Orders that
+        end up not executing (e.g. the user doesn't have enough cash) should be added back.
+
+        Args:
+            ticker (str): The ticker of the stock or crypto.
+            price (float): The current price.
+
+        Returns:
+            list: The BUY orders with an execute_price at or above the price, followed by the SELL
+                orders with an execute_price at or below the price, each in price priority.
+        """
+        ticker = ticker.upper()
+        output = []
+        buys = self._buys.get(ticker)
+        if buys is not None:
+            output.extend(self._pop_while(buys, lambda key: -key >= price))
+            if not buys:
+                del self._buys[ticker]
+        sells = self._sells.get(ticker)
+        if sells is not None:
+            output.extend(self._pop_while(sells, lambda key: key <= price))
+            if not sells:
+                del self._sells[ticker]
+        if self._live.get(ticker) == 0:
+            del self._live[ticker]
+            self._buys.pop(ticker, None)
+            self._sells.pop(ticker, None)
+        else:
+            self._compact(ticker)
+        return output
@@ -0,0 +1,166 @@
+from discord.ext import tasks
+
+import asyncio
+import time
+
+import market
+from indexes import query_shape
+
+
+class PriceHub:
+    """Keeps the prices of the tickers the bot cares about in memory. The working set is the union
+    of tickers with price alerts, tickers with limit orders and tickers held in portfolios. It is
+    refreshed in batches on a fixed schedule and every refresh is published to the subscribers, so
+    one request per ticker serves every consumer.
+    """
+
+    def __init__(self, bot, refresh_interval: float = 60, sync_every: int = 10):
+        """
+        Args:
+            bot (ProfitGreenBot): The bot whose collections and quote fetching functions are used.
+            refresh_interval (float, optional): The number of seconds between refreshes.
+            sync_every (int, optional): The number of refreshes between reloads of the working set
+                from the database.
+        """
+        self.bot = bot
+        self.refresh_interval = refresh_interval
+        self.sync_every = sync_every
+        self.prices = {} # ticker -> latest Quote
+        self._working_set = set()
+        self._subscribers = []
+        self._refresh_count = 0
+        self.refresh.change_interval(seconds=refresh_interval)
+
+    @property
+    def working_set(self):
+        """The tickers that are refreshed on every cycle."""
+        return frozenset(self._working_set)
+
+    def start(self):
+        if not self.refresh.is_running():
+            self.refresh.start()
+
+    def stop(self):
+        self.refresh.stop()
+
+    def track(self, ticker: str):
+        """Adds a ticker to the working set right away instead of waiting for the next sync. This
+        should be called whenever a price alert, limit order or holding is created.
+        """
+        self._working_set.add(ticker.upper())
+
+    def subscribe(self, callback):
+        """Registers a coroutine function that is called with a dict of ticker -> Quote after every
+        refresh.
+        """
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def get(self, ticker: str, max_age: float = None):
+        """Returns the latest in-memory data for a ticker without making any requests.
+
+        Args:
+            ticker (str): The ticker of the stock or crypto.
+            max_age (float, optional): The maximum age of the data in seconds. Defaults to twice
+                the refresh interval, or until the next open for stock quotes fetched after the
+                market closed.
+
+        Returns:
+            Quote or None: The quote or None if the ticker isn't tracked or the quote is too old.
+        """
+        quote = self.prices.get(ticker.upper())
+        if quote is None:
+            return None
+        now = time.time()
+        if max_age is None:
+            expiry = None
+            if quote.asset_type != "crypto":
+                expiry = market.closed_quote_expiry(quote.as_of, now)
+            if expiry is not None and now < expiry:
+                return quote
+            max_age = self.refresh_interval * 2
+        if now - quote.as_of > max_age:
+            return None
+        return quote
+
+    async def fetch(self, tickers: list, max_age: float = None):
+        """Returns the brief data for multiple tickers, reading from memory where possible and
+        fetching the rest with fetch_briefs.
+
+        Args:
+            tickers (list): The tickers of the stocks or cryptos.
+            max_age (float, optional): The maximum age of the in-memory data in seconds.
+
+        Returns:
+            dict: A dict mapping each uppercased ticker to its Quote or a dict containing an error.
+        """
+        output = {}
+        missing = []
+        for ticker in tickers:
+            ticker = ticker.upper()
+            data = self.get(ticker, max_age=max_age)
+            if data is not None:
+                output[ticker] = data
+            else:
+                missing.append(ticker)
+        if missing:
+            output.update(await self.bot.fetch_briefs(missing, max_age=max_age))
+        return output
+
+    @query_shape("Portfolio", {"portfolio.ticker": "AAPL"})
+    async def sync_working_set(self):
+        """Reloads the working set from the alert index, the order book and the Portfolio collection."""
+        await self.bot.tasks_watcher.wait_until_loaded()
+        task_tickers = self.bot.alert_index.tickers() | self.bot.order_book.tickers()
+        if self.bot.worker:
+            # Task workers don't serve commands, so they only need the tickers of their partitions
+            self._working_set = {t for t in task_tickers if self.bot.owns_task(t)}
+        else:
+            held_tickers = await self.bot.portfolio.distinct("portfolio.ticker")
+            self._working_set = {t.upper() for t in held_tickers} | task_tickers
+        # Forget the prices of tickers that are no longer needed
+        for ticker in list(self.prices):
+            if ticker not in self._working_set:
+                del self.prices[ticker]
+
+    @tasks.loop(seconds=60)
+    async def refresh(self):
+        # Reload the working set from the database every few refreshes
+        if self._refresh_count % self.sync_every == 0:
+            await self.sync_working_set()
+        self._refresh_count += 1
+        if not self._working_set:
+            return
+
+        # Refresh the working set in batches. Stocks that were already refreshed after the market
+        # closed are skipped until it opens again since their prices can't change.
+        now = time.time()
+        tickers = []
+        for ticker in self._working_set:
+            quote = self.prices.get(ticker)
+            if quote is None or quote.asset_type == "crypto" or market.closed_quote_expiry(quote.as_of, now) is None:
+                tickers.append(ticker)
+        if not tickers:
+            return
+        quotes = await self.bot.fetch_briefs(tickers, max_age=0)
+        updates = {}
+        for ticker, data in quotes.items():
+            if data.get("error") is None:
+                self.prices[ticker] = data
+                updates[ticker] = data
+
+        # Publish the new prices to the subscribers
+        subscribers = list(self._subscribers)
+        results = await asyncio.gather(*[callback(dict(updates)) for callback in subscribers], return_exceptions=True)
+        for callback, result in zip(subscribers, results):
+            if isinstance(result, Exception):
+                print(f"PriceHub subscriber {callback.__qualname__} failed\n{result.__class__.__name__}: {result}")
+
+    @refresh.before_loop
+    async def before_refresh(self):
+        """Wait until the bot is ready before the task starts."""
+        await self.bot.wait_until_ready()
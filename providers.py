@@ -0,0 +1,201 @@
+import asyncio
+import time
+from collections import deque
+
+
+class ProviderHealth:
+    """Tracks the latency and failures of an upstream quote provider. The provider's circuit is
+    opened after several consecutive failures so that it is skipped until a cooldown has passed.
+    """
+
+    def __init__(self, name: str, window: int = 100, default_p95: float = 1.5, failure_threshold: int = 5, cooldown: float = 30):
+        """
+        Args:
+            name (str): The name of the provider.
+            window (int, optional): The number of recent latencies to keep.
+            default_p95 (float, optional): The p95 latency in seconds to use until enough latencies are recorded.
+            failure_threshold (int, optional): The number of consecutive failures before the circuit opens.
+            cooldown (float, optional): The number of seconds the circuit stays open for.
+        """
+        self.name = name
+        self.default_p95 = default_p95
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.open_until = 0
+
+    @property
+    def p95(self):
+        """The 95th percentile latency of the provider in seconds."""
+        if len(self.latencies) < 20:
+            return self.default_p95
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def available(self):
+        """Returns whether requests should be sent to the provider. Once the cooldown has passed,
+        requests are allowed through again and the next result decides if the circuit closes.
+        """
+        return time.time() >= self.open_until
+
+    def record_success(self, latency: float):
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.open_until = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = time.time() + self.cooldown
+            print(f"Skipping {self.name} for {self.cooldown} seconds after {self.consecutive_failures} consecutive failures")
+
+
+async def timed_request(health: ProviderHealth, fetch):
+    """Awaits a request to a provider and records its latency or failure. Responses with an error
+    code other than 404 count as failures since 404s mean the provider is healthy but the ticker
+    doesn't exist.
+
+    Args:
+        health (ProviderHealth): The health of the provider.
+        fetch (Callable): A function returning a coroutine that performs the request.
+
+    Returns:
+        dict: The output of the request or an error.
+    """
+    start = time.monotonic()
+    try:
+        output = await fetch()
+    except Exception as e:
+        health.record_failure()
+        return {
+            "error": f"The request to {health.name} failed ({e.__class__.__name__}).",
+            "error_code": 503
+        }
+    if output.get("error") is not None and output.get("error_code") != 404:
+        health.record_failure()
+    else:
+        health.record_success(time.monotonic() - start)
+    return output
+
+
+async def hedged_request(providers: list):
+    """Requests data from the first healthy provider. If it fails, or takes longer than its p95
+    latency to respond, the next provider is requested as well and the first successful response
+    is returned. This bounds the latency by the fastest healthy provider instead of the sum of all
+    of them.
+
+    The fetch functions may be served from a cache, so they are expected to record the latency of
+    their upstream request themselves with timed_request. Timing them here would record cache hits
+    as near-zero latencies, which would drag the p95 towards zero and hedge nearly every miss.
+
+    Args:
+        providers (list): A list of (ProviderHealth, fetch) tuples in order of preference, where
+            fetch is a function returning a coroutine that performs the request.
+
+    Returns:
+        dict: The first successful output or the last error if every provider failed.
+    """
+    # Skip providers whose circuits are open unless all of them are open
+    queue = [p for p in providers if p[0].available()] or list(providers)
+    pending = {}
+    output = None
+
+    async def attempt(health: ProviderHealth, fetch):
+        try:
+            return await fetch()
+        except Exception as e:
+            return {
+                "error": f"The request to {health.name} failed ({e.__class__.__name__}).",
+                "error_code": 503
+            }
+
+    def launch():
+        health, fetch = queue.pop(0)
+        pending[asyncio.ensure_future(attempt(health, fetch))] = health
+        return health
+
+    newest = launch()
+    try:
+        while pending:
+            # Only wait for the p95 latency if there is another provider to hedge with
+            timeout = newest.p95 if queue else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                newest = launch() # Hedge with the next provider
+                continue
+            for task in done:
+                pending.pop(task)
+                output = task.result()
+                if output.get("error") is None:
+                    return output
+            # Move on to the next provider if every request in flight has failed
+            if not pending and queue:
+                newest = launch()
+    finally:
+        for task in pending:
+            task.cancel()
+    return output
+
+
+class TokenBucket:
+    """A token bucket that limits the rate of requests to an upstream provider. The rate is halved
+    whenever the provider responds with 429 Too Many Requests and slowly recovers afterwards.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, min_rate: float = None):
+        """
+        Args:
+            name (str): The name of the provider.
+            rate (float): The number of requests allowed per second.
+            burst (int): The maximum number of requests that can be made at once.
+            min_rate (float, optional): The lowest the rate can be reduced to. Defaults to a tenth of rate.
+        """
+        self.name = name
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate / 10
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.waiting = 0
+        self._lock = None
+
+    @property
+    def queue_depth(self):
+        """The number of requests waiting for a token."""
+        return self.waiting
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Waits until a request can be made. Waiters are served in the order they arrived."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now >= self.paused_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep(max(self.paused_until - now, (1 - self.tokens) / self.rate))
+        finally:
+            self.waiting -= 1
+
+    def throttle(self, retry_after: float = None):
+        """Halves the rate after a 429 response and pauses requests for retry_after seconds."""
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        self.paused_until = time.monotonic() + (retry_after if retry_after is not None else 1 / self.rate)
+        print(f"Rate limited by {self.name}, reducing the rate to {round(self.rate, 3)} requests per second")
+
+    def recover(self):
+        """Slowly raises the rate back towards the configured rate after a successful response."""
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
@@ -0,0 +1,109 @@
+import time
+
+
+def format_number(n):
+    """Formats a number with commas and without scientific notation or trailing zeros.
+
+    Args:
+        n (int or float): The number to format.
+
+    Returns:
+        str: The formatted number.
+    """
+    return format(n, ",f").rstrip("0").rstrip(".") # , = format with commas, f = convert scientific notation to decimal
+
+
+def parse_float(value):
+    """Converts a number from an API response (e.g. "+1.23", "(-4.85%)", "1,234.5") into a float.
+
+    Args:
+        value (str, int or float): The value to convert.
+
+    Returns:
+        float or None: The converted value or None if it isn't a number.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip("()%").replace(",", "").replace("%", ""))
+    except ValueError:
+        return None
+
+
+class Quote:
+    """An immutable snapshot of the price of a stock or crypto. Quotes are parsed once when they are
+    received from a provider so that the rest of the bot can use typed fields, and because they can't
+    be modified they are safe to cache and share between commands.
+
+    For compatibility with code that handles error dicts, fields can also be read with quote["price"]
+    or quote.get("price"), and "_type" maps to asset_type.
+    """
+
+    __slots__ = ("ticker", "name", "asset_type", "price", "open", "change", "change_pct", "as_of", "cache_age")
+
+    def __init__(self, ticker: str, name: str, asset_type: str, price: float, open: float, change: float, change_pct: float, as_of: float = None, cache_age: float = 0.0):
+        values = (ticker, name, asset_type, price, open, change, change_pct, as_of if as_of is not None else time.time(), cache_age)
+        for field, value in zip(self.__slots__, values):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Quote objects are immutable, use replace() instead")
+
+    def __delattr__(self, name):
+        raise AttributeError("Quote objects are immutable")
+
+    def __repr__(self):
+        return f"Quote(ticker={self.ticker!r}, price={self.price!r}, as_of={self.as_of!r})"
+
+    def __getitem__(self, key: str):
+        field = "asset_type" if key == "_type" else key
+        if field not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, field)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def replace(self, **changes):
+        """Returns a copy of the quote with the given fields changed."""
+        values = {field: getattr(self, field) for field in self.__slots__}
+        values.update(changes)
+        return Quote(**values)
+
+    @classmethod
+    def from_cnbc(cls, data: dict):
+        """Parses a quote returned by CNBC Finance's API.
+
+        Raises:
+            KeyError, TypeError, ValueError, AttributeError: If the quote doesn't contain a price.
+        """
+        return cls(
+            ticker=data["symbol"].upper(),
+            name=data["name"],
+            asset_type=data["assetType"].lower(),
+            price=float(data["last"]),
+            open=float(data["open"]),
+            change=parse_float(data.get("change")),
+            change_pct=parse_float(data.get("change_pct"))
+        )
+
+    @classmethod
+    def from_summary(cls, data: dict):
+        """Parses a quote summary returned by ProfitGreenAPI (sourced from Yahoo Finance)."""
+        name = data["name"]
+        # Remove the ticker from the end of the name (e.g. "Dogecoin USD (DOGE-USD)")
+        if name.endswith(f" ({data['ticker']})"):
+            name = name[:-len(f" ({data['ticker']})")]
+        return cls(
+            ticker=data["ticker"],
+            name=name,
+            asset_type=data["_type"],
+            price=float(data["price"]),
+            open=float(data["open"]),
+            change=parse_float(data["change-dollar"]),
+            change_pct=parse_float(data["change-percent"]),
+            as_of=data.get("as_of")
+        )
@@ -0,0 +1,120 @@
+from collections import deque
+import heapq
+import itertools
+import math
+import time
+
+
+class ProximityScheduler:
+    """Decides when the tasks of each ticker are checked next. Tickers whose price is close to an
+    alert or order's trigger price, relative to how much the price has been moving, are checked
+    within seconds, while tickers far from any trigger are only checked once the maximum staleness
+    is reached. The next check times are kept in a min-heap.
+
+    The delay comes from treating the price as a random walk: it takes about (distance / volatility)^2
+    seconds for the price to move a relative distance, where the volatility is the standard
+    deviation of the log returns per square root of a second.
+    """
+
+    # Seconds in a regular trading session, used to convert daily volatility into per-second volatility
+    session_seconds = 6.5 * 60 * 60
+
+    def __init__(self, min_interval: float = 5, max_staleness: float = 300, safety: float = 0.25, default_volatility: float = 0.02, history: int = 30):
+        """
+        Args:
+            min_interval (float, optional): The minimum number of seconds between checks of a ticker.
+            max_staleness (float, optional): The maximum number of seconds between checks of a ticker.
+            safety (float, optional): The fraction of the expected time to reach the trigger price
+                that is waited before the next check.
+            default_volatility (float, optional): The daily volatility assumed for tickers without
+                enough price history.
+            history (int, optional): The number of recent prices used to estimate volatility.
+        """
+        self.min_interval = min_interval
+        self.max_staleness = max_staleness
+        self.safety = safety
+        self.default_volatility = default_volatility / math.sqrt(self.session_seconds)
+        self.history = history
+        self._heap = [] # (next check time, sequence number, ticker)
+        self._next = {} # ticker -> (next check time, sequence number)
+        self._delays = {} # ticker -> the last delay it was scheduled with
+        self._prices = {} # ticker -> deque of (timestamp, price)
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._next)
+
+    def __contains__(self, ticker: str):
+        return ticker in self._next
+
+    def tickers(self):
+        """Returns the tickers that are scheduled."""
+        return set(self._next)
+
+    def last_delay(self, ticker: str):
+        """Returns the delay a ticker was last scheduled with, or None if it is new."""
+        return self._delays.get(ticker)
+
+    def schedule(self, ticker: str, at: float):
+        """Schedules the next check of a ticker, replacing its current one."""
+        sequence = next(self._sequence)
+        self._next[ticker] = (at, sequence)
+        heapq.heappush(self._heap, (at, sequence, ticker))
+
+    def pop_due(self, now: float = None):
+        """Removes and returns the tickers whose next check is due."""
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            at, sequence, ticker = heapq.heappop(self._heap)
+            # Skip entries that were rescheduled
+            if self._next.get(ticker) != (at, sequence):
+                continue
+            del self._next[ticker]
+            due.append(ticker)
+        return due
+
+    def observe(self, ticker: str, price: float, timestamp: float):
+        """Records a price of a ticker for the volatility estimate."""
+        prices = self._prices.setdefault(ticker, deque(maxlen=self.history))
+        if prices and timestamp <= prices[-1][0]:
+            return
+        prices.append((timestamp, price))
+
+    def forget(self, ticker: str):
+        """Forgets the price history of a ticker that no longer has any tasks."""
+        self._prices.pop(ticker, None)
+        self._delays.pop(ticker, None)
+
+    def volatility(self, ticker: str):
+        """Returns the volatility of a ticker per square root of a second."""
+        prices = self._prices.get(ticker)
+        if prices is None or len(prices) < 3:
+            return self.default_volatility
+        variance = sum(math.log(b[1] / a[1]) ** 2 for a, b in zip(prices, itertools.islice(prices, 1, None)) if a[1] > 0 and b[1] > 0)
+        elapsed = prices[-1][0] - prices[0][0]
+        if variance == 0 or elapsed <= 0:
+            return self.default_volatility
+        return math.sqrt(variance / elapsed)
+
+    def delay(self, ticker: str, distances):
+        """Returns the number of seconds until a ticker should be checked again.
+
+        Args:
+            ticker (str): The ticker.
+            distances (Iterable): The relative distances (e.g. 0.01 = 1%) from the current price to
+                the nearest trigger price on each side. A distance of 0 means a task is already
+                past its trigger and is waiting on the user (e.g. a limit order they can't afford),
+                so it only needs to be retried at the maximum staleness.
+
+        Returns:
+            float: The delay.
+        """
+        volatility = self.volatility(ticker)
+        delay = self.max_staleness
+        for distance in distances:
+            if distance > 0:
+                delay = min(delay, self.safety * (distance / volatility) ** 2)
+        delay = max(self.min_interval, delay)
+        self._delays[ticker] = delay
+        return delay
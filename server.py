@@ -14,6 +14,9 @@ REMIND_USERS = [
     516066882256764950  # TheGroke#1123
 ]
 
+# The event loop and callback of the bot's reward worker, which new votes are handed to
+VOTE_LISTENER = None
+
 # Initialize the app
 app = Flask(__name__)
 
@@ -21,6 +24,7 @@ app = Flask(__name__)
 client = MongoClient(Config.DB_CONNECTION_STRING)
 db = client.get_database("ProfitGreen")
 tasks = db.get_collection("Tasks")
+jobs = db.get_collection("Jobs")
 
 @app.route("/")
 def home():
@@ -34,21 +38,36 @@ def topgg_webhook():
     Docs:
     https://docs.top.gg/resources/webhooks/
     """
-    # Add the upvote task to the database
-    tasks.insert_one({
+    # Add the upvote task to the database so that it isn't lost if the bot is down, then hand it
+    # straight to the bot's reward worker
+    vote = {
         "_type": "upvote",
         "website": "top.gg",
         "user": request.json["user"]
-    })
-    # Add a task to remind the user to the database
+    }
+    tasks.insert_one(vote) # Sets the vote's _id
+    if VOTE_LISTENER is not None:
+        loop, callback = VOTE_LISTENER
+        loop.call_soon_threadsafe(callback, vote)
+    # Add a delayed job to remind the user to the database. The bot loads it shortly before it is due.
     if int(request.json["user"]) in REMIND_USERS:
-        tasks.insert_one({
-            "_type": "upvote_reminder",
-            "user": request.json["user"],
-            "remind_timestamp": round(time()) + 60 * 60 * 12 # 12 hours from now
+        jobs.insert_one({
+            "job": "upvote_reminder",
+            "due_at": round(time()) + 60 * 60 * 12, # 12 hours from now
+            "data": {"user": request.json["user"]}
         })
     return request.json
 
+def set_vote_listener(loop, callback):
+    """Hands every new vote to a callback, which is called from the thread of its event loop.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The event loop of the callback.
+        callback (Callable): Called with the vote task, or None to stop handing votes over.
+    """
+    global VOTE_LISTENER
+    VOTE_LISTENER = (loop, callback) if callback is not None else None
+
 def run():
     app.run(host="0.0.0.0", port=Config.PORT)
 
@@ -0,0 +1,128 @@
+from discord.ext import tasks
+import pymongo.errors
+
+import math
+import time
+import zlib
+
+from indexes import query_shape
+
+
+def partition_of(key, partitions: int):
+    """Returns the partition of a task key (a ticker or a user id). The hash is stable between
+    processes, unlike hash().
+    """
+    return zlib.crc32(str(key).upper().encode()) % partitions
+
+
+class PartitionLeases:
+    """Splits the background tasks between worker processes. Tasks are assigned to a fixed number
+    of partitions by a hash of their ticker or user, and each partition is leased to one worker
+    through a document in the Leases collection. Every worker sends a heartbeat to the Workers
+    collection, renews its leases, and takes or gives up partitions so that each live worker owns
+    an even share. Leases of a worker that stops renewing them expire and are taken over by the
+    other workers.
+    """
+
+    def __init__(self, leases, workers, worker_id: str, partitions: int = 16, lease_ttl: float = 30, heartbeat_interval: float = 10):
+        """
+        Args:
+            leases (motor.motor_asyncio.AsyncIOMotorCollection): The collection of partition leases.
+            workers (motor.motor_asyncio.AsyncIOMotorCollection): The collection of worker heartbeats.
+            worker_id (str): The unique id of this worker.
+            partitions (int, optional): The number of partitions. Must be the same for every worker.
+            lease_ttl (float, optional): The number of seconds a lease lasts without being renewed.
+            heartbeat_interval (float, optional): The number of seconds between heartbeats.
+        """
+        self.leases = leases
+        self.workers = workers
+        self.worker_id = worker_id
+        self.partitions = partitions
+        self.lease_ttl = lease_ttl
+        self.owned = {} # partition -> unix timestamp its lease expires at
+        self._listeners = []
+        self.heartbeat.change_interval(seconds=heartbeat_interval)
+
+    def start(self):
+        if not self.heartbeat.is_running():
+            self.heartbeat.start()
+
+    @query_shape("Leases", {"owner": "worker"})
+    async def stop(self):
+        """Stops sending heartbeats and releases every lease so other workers can take over right away."""
+        self.heartbeat.cancel()
+        await self.leases.update_many({"owner": self.worker_id}, {"$set": {"owner": None, "expires_at": 0}})
+        await self.workers.delete_one({"_id": self.worker_id})
+        self.owned.clear()
+
+    def subscribe(self, callback):
+        """Calls a function with the list of partitions every time this worker takes some over, so
+        that tasks skipped while another worker held them can be picked up.
+        """
+        self._listeners.append(callback)
+
+    def owns(self, key):
+        """Returns whether this worker currently holds the lease of a task key's partition. A lease
+        that wasn't renewed in time is treated as lost, even before another worker takes it.
+        """
+        expires_at = self.owned.get(partition_of(key, self.partitions))
+        return expires_at is not None and time.time() < expires_at
+
+    @query_shape("Workers", {"seen_at": {"$gt": 0}})
+    async def _live_workers(self, now: float):
+        return await self.workers.count_documents({"seen_at": {"$gt": now - self.lease_ttl}})
+
+    async def _renew(self, now: float):
+        expires_at = now + self.lease_ttl
+        for partition in list(self.owned):
+            result = await self.leases.update_one({"_id": partition, "owner": self.worker_id}, {"$set": {"expires_at": expires_at}})
+            if result.matched_count:
+                self.owned[partition] = expires_at
+            else:
+                del self.owned[partition] # Another worker took the partition over
+
+    async def _acquire(self, partition: int, now: float):
+        try:
+            result = await self.leases.update_one(
+                {"_id": partition, "$or": [{"owner": None}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.worker_id, "expires_at": now + self.lease_ttl}}
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        if result.matched_count:
+            self.owned[partition] = now + self.lease_ttl
+            return True
+        return False
+
+    async def _release(self, partition: int):
+        await self.leases.update_one({"_id": partition, "owner": self.worker_id}, {"$set": {"owner": None, "expires_at": 0}})
+        self.owned.pop(partition, None)
+
+    @tasks.loop(seconds=10)
+    async def heartbeat(self):
+        now = time.time()
+        try:
+            await self.workers.update_one({"_id": self.worker_id}, {"$set": {"seen_at": now}}, upsert=True)
+            await self._renew(now)
+
+            # Take or give up partitions so that every live worker owns an even share
+            share = math.ceil(self.partitions / max(1, await self._live_workers(now)))
+            while len(self.owned) > share:
+                await self._release(max(self.owned))
+            acquired = []
+            for partition in range(self.partitions):
+                if len(self.owned) >= share:
+                    break
+                if partition not in self.owned and await self._acquire(partition, now):
+                    acquired.append(partition)
+            if acquired:
+                for callback in self._listeners:
+                    callback(acquired)
+        except pymongo.errors.PyMongoError as e:
+            print(f"Partition heartbeat of {self.worker_id} failed\n{e.__class__.__name__}: {e}")
+
+    @heartbeat.before_loop
+    async def before_heartbeat(self):
+        """Creates the lease documents of partitions that don't have one yet."""
+        for partition in range(self.partitions):
+            await self.leases.update_one({"_id": partition}, {"$setOnInsert": {"owner": None, "expires_at": 0}}, upsert=True)
@@ -0,0 +1,155 @@
+from discord.ext import tasks
+import pymongo.errors
+
+import asyncio
+
+
+class TasksWatcher:
+    """Keeps an in-memory copy of the Tasks collection. The collection is loaded once and then kept
+    up to date by applying the inserts, updates and deletes from a MongoDB change stream, so the
+    background loops can read their tasks from memory instead of scanning the collection.
+
+    If the change stream is interrupted it is resumed from the last resume token. If the server
+    doesn't support change streams (i.e. it isn't a replica set), the watcher falls back to diffing
+    the collection against the in-memory copy on every run.
+
+    Indexes can register to receive the documents of a task type, e.g. the alert index receives
+    every price_alert.
+    """
+
+    # Error codes meaning change streams aren't available on the server
+    unsupported_codes = (
+        40573, # The $changeStream stage is only supported on replica sets
+        40324, # Unrecognized pipeline stage name
+        115 # CommandNotSupported
+    )
+    # Error code meaning the resume token is no longer in the oplog
+    history_lost_code = 286
+
+    def __init__(self, collection, poll_interval: float = 60):
+        """
+        Args:
+            collection (motor.motor_asyncio.AsyncIOMotorCollection): The Tasks collection.
+            poll_interval (float, optional): The number of seconds between diffs when change
+                streams aren't available, and between reconnects when the change stream fails.
+        """
+        self.collection = collection
+        self.documents = {} # str(_id) -> task document
+        self.change_streams = True
+        self.resume_token = None
+        self._handlers = {} # _type -> list of (add, remove)
+        self._loaded = asyncio.Event()
+        self.run.change_interval(seconds=poll_interval)
+
+    @property
+    def loaded(self):
+        return self._loaded.is_set()
+
+    def start(self):
+        if not self.run.is_running():
+            self.run.start()
+
+    def stop(self):
+        self.run.cancel()
+
+    async def wait_until_loaded(self):
+        await self._loaded.wait()
+
+    def register(self, _type: str, add, remove):
+        """Registers an index that receives the tasks of a type.
+
+        Args:
+            _type (str): The type of the tasks.
+            add (Callable): Called with a task document when it is inserted or updated.
+            remove (Callable): Called with the _id of a task when it is deleted.
+        """
+        self._handlers.setdefault(_type, []).append((add, remove))
+
+    def find(self, _type: str):
+        """Returns a list of the in-memory tasks of a type."""
+        return [doc for doc in self.documents.values() if doc.get("_type") == _type]
+
+    def forget(self, _id):
+        """Removes a task from memory right after it was deleted, without waiting for the change."""
+        self._remove(str(_id))
+
+    def _upsert(self, doc: dict):
+        key = str(doc["_id"])
+        old = self.documents.get(key)
+        # A task that changed type is removed from the indexes of its old type
+        if old is not None and old.get("_type") != doc.get("_type"):
+            self._remove(key)
+        self.documents[key] = doc
+        for add, _ in self._handlers.get(doc.get("_type"), []):
+            add(doc)
+
+    def _remove(self, key: str):
+        doc = self.documents.pop(key, None)
+        if doc is None:
+            return
+        for _, remove in self._handlers.get(doc.get("_type"), []):
+            remove(doc["_id"])
+
+    def apply(self, change: dict):
+        """Applies a change stream event to the in-memory tasks."""
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            doc = change.get("fullDocument")
+            # The document was deleted before the update could be looked up
+            if doc is None:
+                self._remove(str(change["documentKey"]["_id"]))
+            else:
+                self._upsert(doc)
+        elif operation == "delete":
+            self._remove(str(change["documentKey"]["_id"]))
+        elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            # The stream can't continue, so reload the collection on the next run
+            self.resume_token = None
+
+    async def sync(self):
+        """Loads the collection and applies the differences from the in-memory tasks."""
+        cursor = self.collection.find({})
+        docs = {str(doc["_id"]): doc for doc in await cursor.to_list(length=None)}
+        for key in list(self.documents):
+            if key not in docs:
+                self._remove(key)
+        for key, doc in docs.items():
+            if self.documents.get(key) != doc:
+                self._upsert(doc)
+        self._loaded.set()
+
+    async def _watch(self):
+        async with self.collection.watch(full_document="updateLookup", resume_after=self.resume_token) as stream:
+            if self.resume_token is None:
+                # Open the stream before loading so that no change made in between is missed.
+                # Changes already included in the load are applied again, which is harmless.
+                change = await stream.try_next()
+                await self.sync()
+                if change is not None:
+                    self.apply(change)
+                self.resume_token = stream.resume_token
+            async for change in stream:
+                self.resume_token = stream.resume_token
+                self.apply(change)
+                if self.resume_token is None:
+                    return
+
+    @tasks.loop(seconds=60)
+    async def run(self):
+        if self.change_streams:
+            try:
+                await self._watch()
+            except pymongo.errors.OperationFailure as e:
+                if e.code in self.unsupported_codes:
+                    print("Change streams aren't supported by the database, falling back to diffing the Tasks collection")
+                    self.change_streams = False
+                elif e.code == self.history_lost_code:
+                    print("The Tasks change stream can't be resumed, reloading the collection")
+                    self.resume_token = None
+                else:
+                    print(f"The Tasks change stream failed\n{e.__class__.__name__}: {e}")
+            except pymongo.errors.PyMongoError as e:
+                # Resume from the last token on the next run
+                print(f"The Tasks change stream was interrupted\n{e.__class__.__name__}: {e}")
+        if not self.change_streams:
+            await self.sync()
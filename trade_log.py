@@ -0,0 +1,121 @@
+from discord.ext import tasks
+import pymongo
+import pymongo.errors
+
+import asyncio
+
+from indexes import query_shape
+
+
+class TradeLog:
+    """Stores the trade history of every user in the TradeHistory collection, indexed by
+    (user_id, timestamp), instead of in an array in each portfolio. Trades are buffered in memory
+    and written in batches with insert_many, either when the buffer is full or on the next flush.
+    """
+
+    def __init__(self, collection, portfolio_collection, batch_size: int = 100, flush_interval: float = 5):
+        """
+        Args:
+            collection (motor.motor_asyncio.AsyncIOMotorCollection): The TradeHistory collection.
+            portfolio_collection (motor.motor_asyncio.AsyncIOMotorCollection): The Portfolio
+                collection, whose embedded trade histories are migrated.
+            batch_size (int, optional): The number of buffered trades that triggers a write.
+            flush_interval (float, optional): The maximum number of seconds a trade is buffered for.
+        """
+        self.collection = collection
+        self.portfolio_collection = portfolio_collection
+        self.batch_size = batch_size
+        self._buffer = []
+        self._flush_lock = None
+        self.flush_buffer.change_interval(seconds=flush_interval)
+
+    def start(self):
+        if not self.flush_buffer.is_running():
+            self.flush_buffer.start()
+
+    async def stop(self):
+        """Stops the flush loop and writes the trades that are still buffered."""
+        self.flush_buffer.cancel()
+        await self.flush()
+
+    def record(self, user_id: int, trade: dict):
+        """Buffers a trade for a user.
+
+        Args:
+            user_id (int): The id of the user.
+            trade (dict): The trade created by ProfitGreenBot.trade_record.
+        """
+        self._buffer.append(dict(trade, user_id=user_id))
+        if len(self._buffer) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Writes the buffered trades to the database in one batch."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                # Put back the trades that failed for a reason other than already being written
+                failed = {error["index"] for error in e.details["writeErrors"] if error["code"] != 11000}
+                self._buffer[:0] = [trade for i, trade in enumerate(batch) if i in failed]
+                print(f"Failed to write {len(failed)} trades to the trade history")
+            except pymongo.errors.PyMongoError as e:
+                # Keep the trades so they're written on the next flush
+                self._buffer[:0] = batch
+                print(f"Failed to write {len(batch)} trades to the trade history\n{e.__class__.__name__}: {e}")
+
+    @query_shape("TradeHistory", {"user_id": 0}, [("timestamp", pymongo.DESCENDING)])
+    async def fetch_trades(self, user_id: int, limit: int = 0):
+        """Fetches the trade history of a user, newest first.
+
+        Args:
+            user_id (int): The id of the user.
+            limit (int, optional): The maximum number of trades to return. Defaults to all of them.
+
+        Returns:
+            list: The trades.
+        """
+        await self.flush()
+        cursor = self.collection.find({"user_id": user_id}, {"_id": 0}).sort("timestamp", pymongo.DESCENDING).limit(limit)
+        return await cursor.to_list(length=None)
+
+    async def migrate(self):
+        """Moves the trade_history arrays embedded in portfolios into the TradeHistory collection.
+        Portfolios are streamed one at a time so the whole collection is never held in memory. The
+        migrated trades get deterministic _ids, so rerunning an interrupted migration doesn't
+        duplicate them.
+        """
+        migrated = 0
+        cursor = self.portfolio_collection.find({"trade_history": {"$exists": True}}, {"trade_history": 1})
+        async for doc in cursor:
+            trades = [dict(trade, _id=f"{doc['_id']}:{i}", user_id=doc["_id"]) for i, trade in enumerate(doc["trade_history"])]
+            if trades:
+                try:
+                    await self.collection.insert_many(trades, ordered=False)
+                except pymongo.errors.BulkWriteError as e:
+                    # Trades left over from an interrupted migration are already written
+                    if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                        print(f"Failed to migrate the trade history of {doc['_id']}")
+                        continue
+            # Only remove the trades that were migrated, in case one was added in the meantime
+            await self.portfolio_collection.update_one(
+                {"_id": doc["_id"], "trade_history": {"$size": len(doc["trade_history"])}},
+                {"$unset": {"trade_history": ""}}
+            )
+            migrated += len(trades)
+        if migrated:
+            print(f"Migrated {migrated} trades to the trade history collection")
+
+    @tasks.loop(seconds=5)
+    async def flush_buffer(self):
+        await self.flush()
+
+    @flush_buffer.before_loop
+    async def before_flush_buffer(self):
+        """Migrates the embedded trade histories before the first flush."""
+        await self.migrate()
@@ -0,0 +1,58 @@
+# worker.py - Runs the background tasks of ProfitGreen without connecting to the gateway
+import discord
+from discord.ext import commands
+
+import asyncio
+import signal
+import sys
+
+from config import Config
+from extras import *
+
+
+# Refuse to start unless the bot leaves the tasks to the task workers. Otherwise the bot would run
+# every task while the workers run the tasks of their partitions, and each would be run twice.
+if not Config.TASK_WORKERS:
+    print("Task workers can only run when TASK_WORKERS is set, since the bot runs every task otherwise.")
+    sys.exit(1)
+
+# Create the task worker. It never connects to the gateway, so it doesn't need any intents.
+bot = ProfitGreenBot (
+                command_prefix=commands.when_mentioned_or(Config.PREFIX),
+                intents=discord.Intents.none(),
+                worker=True
+                )
+
+# Set the developer's id
+bot.owner_id = 416730155332009984
+# Set the Top.gg token
+bot.topgg_token = Config.TOPGG_TOKEN
+# Set the log channel(s)
+bot.log_channels = [941105200586952735, # #logging
+                    896527153422794792  # #bubble-announcements
+]
+
+
+async def main():
+    # Stop cleanly so that the leases are released and the buffered trades are written
+    stopped = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        bot.loop.add_signal_handler(sig, stopped.set)
+
+    # Only log in over REST, which is enough to fetch users, send DMs and post in channels
+    await bot.login(Config.TOKEN)
+    print(f"Task worker {Config.WORKER_ID} logged in as {bot.user}.")
+
+    # Take a share of the partitions and run the tasks in them
+    bot.partitions.start()
+    bot.trade_log.start()
+    bot.load_extension("cogs.tasks")
+    bot.load_extension("cogs.utils")
+    try:
+        await stopped.wait()
+    finally:
+        await bot.close()
+
+
+# Run the worker
+bot.loop.run_until_complete(main())
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+
+class CycleStats:
+    """Counts what happened to the tasks in one cycle of a WorkerPool."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.evaluated = 0 # Tasks the handler was called with
+        self.triggered = 0 # Tasks the handler returned True for
+        self.failed = 0 # Tasks the handler raised an exception for
+        self.carried_over = 0 # Tasks left for the next cycle because the deadline passed or they failed
+        self.duration = 0.0
+
+    def __repr__(self):
+        return f"CycleStats(name={self.name!r}, evaluated={self.evaluated}, triggered={self.triggered}, failed={self.failed}, carried_over={self.carried_over}, duration={self.duration:.2f})"
+
+
+class WorkerPool:
+    """Runs a handler over the tasks of a cycle with a bounded number of concurrent workers, so a
+    slow DM or database call only holds up its own worker.
+
+    Tasks that share a key (e.g. the same user) are handled one after another, in the order they
+    were given, by a single worker, so they never race on the same document. Once the deadline of
+    a cycle has passed, workers stop starting new tasks and the rest are carried over along with
+    the tasks that raised an exception. Tasks that are already running are left to finish so that
+    no update is cut off halfway.
+    """
+
+    def __init__(self, name: str, concurrency: int = 8, deadline: float = None):
+        """
+        Args:
+            name (str): The name of the pool, used in logs.
+            concurrency (int, optional): The maximum number of tasks handled at the same time.
+            deadline (float, optional): The number of seconds after the start of a cycle after
+                which no new tasks are started. Defaults to no deadline.
+        """
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.deadline = deadline
+        self.last_stats = None
+
+    async def run(self, items, handler, key):
+        """Handles the tasks of one cycle.
+
+        Args:
+            items (Iterable): The tasks to handle.
+            handler (Callable): A coroutine function called with each task. It should return True
+                if the task was triggered.
+            key (Callable): A function returning the key of a task. Tasks with the same key are
+                handled in order.
+
+        Returns:
+            tuple: The CycleStats of the cycle and the list of tasks that were carried over.
+        """
+        # Group the tasks by key, keeping the order of the tasks within each group
+        groups = {}
+        for item in items:
+            groups.setdefault(key(item), []).append(item)
+        queue = list(groups.values())
+        queue.reverse() # Pop groups from the end in their original order
+
+        stats = CycleStats(self.name)
+        carried = []
+        start = time.monotonic()
+        deadline = start + self.deadline if self.deadline is not None else None
+
+        async def worker():
+            while queue:
+                group = queue.pop()
+                for i, item in enumerate(group):
+                    if deadline is not None and time.monotonic() >= deadline:
+                        carried.extend(group[i:])
+                        break
+                    stats.evaluated += 1
+                    try:
+                        if await handler(item):
+                            stats.triggered += 1
+                    except Exception as e:
+                        stats.failed += 1
+                        carried.append(item)
+                        print(f"{self.name} failed to handle a task\n{e.__class__.__name__}: {e}")
+
+        await asyncio.gather(*[worker() for _ in range(min(self.concurrency, len(groups)))])
+
+        stats.carried_over = len(carried)
+        stats.duration = time.monotonic() - start
+        self.last_stats = stats
+        if carried:
+            print(f"{self.name} carried {len(carried)} tasks over to the next cycle after {stats.duration:.2f}s ({stats.failed} failed)")
+        return stats, carried